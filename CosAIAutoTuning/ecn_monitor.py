@@ -1,26 +1,29 @@
 import os
+import sys
 import time
 import urllib.parse
 from string import Template
 
-import pysnow
 import requests
 import urllib3
 import yaml
-from aos.client import AosClient
-from python_terraform import *
+
+# pysnow, python_terraform and aos.client are imported where they are used: they are slow to import
+# and not every run needs all of them (--init and --restore-original quit before ServiceNow is used)
 
 setup = {}
 
 
 # Do Terraform Initialize
 def terraform_init():
+    from python_terraform import Terraform
     t = Terraform()
     t.init()
 
 
 # Do Terraform Apply
 def terraform_apply():
+    from python_terraform import Terraform
     t = Terraform()
     t.apply(skip_plan=True)
 
@@ -41,6 +44,7 @@ def save_setup():
 
 # Set up the apstra client
 def get_apstra_client():
+    from aos.client import AosClient
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
     aos_ip = os.environ.get('APSTRA_URL').split("https://")[1]
     aos_port = os.environ.get('APSTRA_PORT')
@@ -59,8 +63,33 @@ def print_anomalies(ano):
         print(a['identity']['stage_name'])
 
 
-# Get all anomalies
+# Probe label -> probe id, looked up once
+probe_ids = {}
+
+
+def get_probe_ids(bp_id):
+    global probe_ids
+    if not probe_ids:
+        probes = aos.rest.json_resp_get("api/blueprints/" + bp_id + "/probes")
+        probe_ids = {p['label']: p['id'] for p in probes.get('items', [])}
+    return probe_ids
+
+
+# Get the anomalies of the ECN, PFC and drop probes only.
+# Falls back to all anomalies if a probe can't be found or queried.
 def get_anomalies(bp_id):
+    global probe_ids
+    labels = [setup['ecn_probe_name'], setup['pfc_probe_name'], setup['drop_probe_name']]
+    try:
+        ids = get_probe_ids(bp_id)
+        if all(ids.get(l) for l in labels):
+            ano = []
+            for l in labels:
+                ano.extend(aos.rest.json_resp_get("api/blueprints/" + bp_id + "/probes/" + ids[l] + "/anomalies")['items'])
+            return ano
+    except Exception as e:
+        print("Probe anomaly query failed, fetching all anomalies. %s" % e)
+        probe_ids = {}
     ano = aos.rest.json_resp_get("api/blueprints/" + bp_id + "/anomalies")
     return ano['items']
 
@@ -385,6 +414,7 @@ if len(sys.argv) > 1:
 if not setup.get('fill_level_low'):
     reset_original()
 
+import pysnow
 snow = pysnow.Client(instance=setup['snow']['instance'], user=setup['snow']['user'], password=os.environ.get("SNOW_PASS"))
 # Define a resource, here we'll use the incident table API
 incident = snow.resource(api_path='/table/incident')
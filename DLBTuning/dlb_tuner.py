@@ -1,29 +1,45 @@
-from power_pack import PowerPackBase
+import threading
+
+from apstra_client import DeployBatcher
+from power_pack import PowerPackBase, startup_profile
 
 
 class DLBTunerPack(PowerPackBase):
-    def __init__(self):
-        super().__init__(worker_callback=self.worker, checker_callback=self.get_pause)
+    def __init__(self, setup_file="setup.yaml", aos_client=None):
+        super().__init__(worker_callback=self.worker, checker_callback=self.get_pause, setup_file=setup_file,
+                         aos_client=aos_client)
         self.ps_manager = self.setup['management_property_set']
-        self.bp_id = self.get_bp_id()
-        self.lb_policy = self.get_lb_policy()
+        with startup_profile.phase("DLBTunerPack settings"):
+            self.bp_id = self.get_bp_id()
+            self.lb_policy = self.get_lb_policy()
+            self.inactivity_timer_delta = self.get_inactivity_timer_delta()
+            self.oos_probe = self.get_oos_probe()
         self.oos_packets = 0
         self.old_oos = 0
-        self.inactivity_timer_delta = self.get_inactivity_timer_delta()
+        self.pending_delta = 0
+        self.pending_lock = threading.Lock()
+        self.batcher = DeployBatcher(self.aos_client, self.setup.get('deploy_batch_window_seconds', 0))
 
+    # Deltas staged within the batch window are summed and written with one policy update and one deploy
     def update_dlb_inactivity_interval(self, delta):
-        policy = self.aos_client.get_load_balancing_policy(self.bp_id, self.lb_policy)
+        with self.pending_lock:
+            self.pending_delta = self.pending_delta + delta
+        self.batcher.stage(self.bp_id, 'dlb_inactivity_interval', self.apply_inactivity_delta)
+
+    def apply_inactivity_delta(self, client):
+        with self.pending_lock:
+            delta, self.pending_delta = self.pending_delta, 0
+        policy = client.get_load_balancing_policy(self.bp_id, self.lb_policy)
         inactivity_interval = policy['dlb_options']['flowlet_options']['inactivity_interval']
         print(f"Current Inactivity Interval {inactivity_interval}")
         policy['dlb_options']['flowlet_options']['inactivity_interval'] = inactivity_interval + delta
-        self.aos_client.update_load_balancing_policy(self.bp_id, policy['id'], policy)
-        self.aos_client.deploy_blueprint(self.bp_id,
-            f"OOS Packets seen {self.oos_packets}. Updating inactivity timer to {inactivity_interval + delta}")
+        client.update_load_balancing_policy(self.bp_id, policy['id'], policy)
+        return f"OOS Packets seen {self.oos_packets}. Updating inactivity timer to {inactivity_interval + delta}"
 
     def worker(self):
         # Get pause value
         self.unchanged = 2
-        oos = self.aos_client.get_oos_anomalies(self.bp_id)
+        oos = self.aos_client.get_oos_anomalies(self.bp_id, self.oos_probe)
         oos_packets = 0
         delta = 0
         for o in oos:
@@ -51,6 +67,14 @@ class DLBTunerPack(PowerPackBase):
         else:
             self.old_oos = oos_packets
 
+        # Active while tuning: keeps an adaptive interval at its floor
+        return delta != 0 or self.batcher.pending(self.bp_id)
+
+    # Deploy whatever is still waiting in the batch window once the worker has drained
+    def stop(self, timeout=10):
+        super().stop(timeout)
+        self.batcher.flush()
+
     def get_pause(self):
         ps = self.aos_client.get_property_set(self.ps_manager)
         if ps.get('values'):
@@ -62,7 +86,7 @@ class DLBTunerPack(PowerPackBase):
         if ps.get('values'):
             bp = ps['values'].get("blueprint")
             if bp:
-                return self.aos_client.get_bp_by_label(bp.strip())['id']
+                return self.aos_client.get_bp_id_by_label(bp.strip())
             return ps['values'].get("blueprint_id")
         return self.setup.get('blueprint_id')
 
@@ -78,6 +102,13 @@ class DLBTunerPack(PowerPackBase):
             return ps['values'].get("inactivity_timer_delta")
         return self.setup.get('inactivity_timer_delta')
 
+    # Probe raising the out of sequence anomalies. When set, only that probe's anomalies are fetched
+    def get_oos_probe(self):
+        ps = self.aos_client.get_property_set(self.ps_manager)
+        if ps.get('values') and ps['values'].get("oos_probe"):
+            return ps['values'].get("oos_probe")
+        return self.setup.get('oos_probe')
+
 
 if __name__ == '__main__':
     pp = DLBTunerPack()
@@ -0,0 +1 @@
+../power_pack/streaming_receiver.py
\ No newline at end of file
@@ -0,0 +1,98 @@
+import fnmatch
+import re
+
+# Management property set rules: (key, anomaly field, include). An anomaly is ignored when an include
+# rule does not match it or an ignore rule does.
+RULES = (
+    ('ignore_anomalies', 'anomaly_type', False),
+    ('ignore_devices', 'device', False),
+    ('include_only_anomalies', 'anomaly_type', True),
+    ('include_only_devices', 'device', True),
+    ('include_only_severity', 'severity', True),
+)
+RULE_KEYS = tuple(key for key, _, _ in RULES)
+
+# Per-blueprint rules, by blueprint label or id: {"dc1": {"ignore_devices": ["leaf*"]}, ...}.
+# The keys given for a blueprint replace the global ones, the others still apply.
+OVERRIDES_KEY = 'blueprint_filters'
+
+WILDCARD = re.compile(r"[*?\[]")
+
+
+# One rule's values: exact values in a set, wildcard patterns (fnmatch syntax) folded into one regex
+class Matcher:
+    def __init__(self, values):
+        self.exact = {v for v in values if not WILDCARD.search(v)}
+        patterns = [fnmatch.translate(v) for v in values if WILDCARD.search(v)]
+        self.pattern = re.compile("|".join(patterns)) if patterns else None
+
+    # None for an unset or empty rule. Values are a list or a comma separated string.
+    @classmethod
+    def compile(cls, values):
+        if isinstance(values, str):
+            values = values.split(",")
+        values = [str(v).strip() for v in values or () if str(v).strip()]
+        return cls(values) if values else None
+
+    def matches(self, value):
+        if value is None:
+            return False
+        return value in self.exact or (self.pattern is not None and self.pattern.match(value) is not None)
+
+
+# The rules of one scope (global or one blueprint) as a tuple of the checks that are set
+class FilterRules:
+    def __init__(self, values):
+        checks = []
+        for key, field, include in RULES:
+            matcher = Matcher.compile(values.get(key))
+            if matcher:
+                checks.append((field, matcher, include))
+        self.checks = tuple(checks)
+        # The device lookup is skipped when no rule is about devices
+        self.needs_device = any(field == 'device' for field, _, _ in self.checks)
+
+    def ignores(self, fields):
+        for field, matcher, include in self.checks:
+            if matcher.matches(fields[field]) != include:
+                return True
+        return False
+
+
+# Anomaly filter compiled from the management property set values. Compile it again when the rules
+# change (see rules_of) rather than for every anomaly.
+class AnomalyFilter:
+    def __init__(self, values):
+        self.rules = rules_of(values)
+        self.default = FilterRules(self.rules)
+        self.overrides = {bp: FilterRules(self.rules | override)
+                          for bp, override in (self.rules.get(OVERRIDES_KEY) or {}).items()}
+        self.ignored = 0
+
+    def rules_for(self, bp_id=None, bp_label=None):
+        return self.overrides.get(bp_id) or self.overrides.get(bp_label) or self.default
+
+    # device_of(anomaly) gives the hostname of the anomaly's system, None when it is unknown
+    def ignores(self, a, device_of, bp_id=None, bp_label=None):
+        rules = self.rules_for(bp_id, bp_label)
+        return rules.ignores(fields_of(a, device_of if rules.needs_device else None))
+
+    # The anomalies (a list) of one blueprint that pass the filter, in one pass over the batch
+    def select(self, anomalies, device_of, bp_id=None, bp_label=None):
+        rules = self.rules_for(bp_id, bp_label)
+        if not rules.checks:
+            return anomalies
+        device_of = device_of if rules.needs_device else None
+        selected = [a for a in anomalies if not rules.ignores(fields_of(a, device_of))]
+        self.ignored += len(anomalies) - len(selected)
+        return selected
+
+
+# The part of the property set values the filter is compiled from, to tell whether it changed
+def rules_of(values):
+    return {k: values[k] for k in RULE_KEYS + (OVERRIDES_KEY,) if k in (values or {})}
+
+
+def fields_of(a, device_of=None):
+    return {'anomaly_type': a.get('anomaly_type'), 'severity': a.get('severity'),
+            'device': device_of(a) if device_of else None}
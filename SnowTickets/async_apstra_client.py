@@ -0,0 +1 @@
+../apstra/async_apstra_client.py
\ No newline at end of file
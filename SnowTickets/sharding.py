@@ -0,0 +1 @@
+../power_pack/sharding.py
\ No newline at end of file
@@ -0,0 +1,75 @@
+import base64
+import itertools
+import json
+import logging
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+BATCH_PATH = "/api/now/v1/batch"
+JSON_HEADERS = [{'name': "Content-Type", 'value': "application/json"},
+                {'name': "Accept", 'value': "application/json"}]
+
+
+# ServiceNow Batch API transport: many table API requests carried by one POST to /api/now/v1/batch.
+# Request bodies travel base64 encoded; every serviced request comes back with its own status and body,
+# matched to the request by id.
+class SnowBatch:
+    def __init__(self, base_url, user, password, chunk_size=50, timeout=60, verify=True):
+        self.base_url = base_url.rstrip('/')
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.auth = (user, password)
+        self.session.verify = verify
+        self.session.headers.update({'Content-Type': "application/json", 'Accept': "application/json"})
+        self.batches = 0
+        self.items = 0
+        self.failed = 0
+        self._ids = itertools.count(1)
+
+    # One table API request of a batch. url is relative to the instance, query string included.
+    @staticmethod
+    def rest_request(method, url, body=None):
+        r = {'method': method, 'url': url, 'headers': JSON_HEADERS}
+        if body is not None:
+            r['body'] = base64.b64encode(json.dumps(body).encode()).decode()
+        return r
+
+    def chunks(self, items):
+        for i in range(0, len(items), self.chunk_size):
+            yield items[i:i + self.chunk_size]
+
+    # Send up to chunk_size requests in one batch. Returns (result, error) per request, in order:
+    # result is the decoded 'result' of the request's response, error an Exception when the request
+    # failed or was not serviced. A failure of the batch request itself raises.
+    def execute(self, rest_requests):
+        batch_id = str(next(self._ids))
+        body = {'batch_request_id': batch_id,
+                'rest_requests': [r | {'id': str(i)} for i, r in enumerate(rest_requests)]}
+        response = self.session.post(f"{self.base_url}{BATCH_PATH}", json=body, timeout=self.timeout)
+        response.raise_for_status()
+        serviced = {r['id']: r for r in response.json().get('serviced_requests', [])}
+        self.batches += 1
+        self.items += len(rest_requests)
+        results = []
+        for i, r in enumerate(rest_requests):
+            s = serviced.get(str(i))
+            if s is None:
+                results.append((None, Exception(f"{r['method']} {r['url']} not serviced in batch {batch_id}")))
+                continue
+            decoded = json.loads(base64.b64decode(s['body'])) if s.get('body') else {}
+            if s['status_code'] >= 400:
+                message = (decoded.get('error') or {}).get('message', s.get('status_text'))
+                results.append((None, Exception(f"{r['method']} {r['url']} failed with {s['status_code']}: {message}")))
+            else:
+                results.append((decoded.get('result'), None))
+        for _, error in results:
+            if error is not None:
+                self.failed += 1
+                logger.error(f"Batch {batch_id}: {error}")
+        return results
+
+    def stats(self):
+        return {'batches': self.batches, 'items': self.items, 'failed': self.failed}
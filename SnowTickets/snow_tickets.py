@@ -1,62 +1,300 @@
+import asyncio
+import contextlib
 import logging
 import os
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
 
-import pysnow
 import sys
 
 sys.path.insert(1, "../PowerPackBase")
-from power_pack import PowerPackBase
+from anomaly_filter import AnomalyFilter, rules_of
+from apstra_client import AnomalyTracker
+from power_pack import PowerPackBase, startup_profile
+from snow_batch import SnowBatch
+from state_store import StateStore
+from ticket_pipeline import TicketPipeline
+
+
+# Work note and resolution of a ticket whose anomaly cleared
+RESOLVE_PAYLOAD = {'work_notes': "Anomaly resolved in Apstra.", "close_code": "Resolved By Caller", "state": "6",
+                   "close_notes": "Closed by API"}
 
 
 class SNOWPowerPack(PowerPackBase):
-    def __init__(self):
-        super().__init__(worker_callback=self.worker, checker_callback=self.get_pause)
-        self.tickets = {}
+    # shard: a sharding.ShardMember when this process is one of several sharing the blueprints
+    def __init__(self, setup_file="setup.yaml", aos_client=None, shard=None):
+        super().__init__(worker_callback=self.worker, checker_callback=self.get_pause,
+                         setup_file=setup_file, event_callback=self.on_anomaly_event, aos_client=aos_client)
+        self.anomaly_tracker = AnomalyTracker()
+        self.anomaly_filter = None
+        self.shard = shard
+        # Open tickets by anomaly id. Written to the tickets property set only when they changed,
+        # at most every state_flush_interval_seconds
+        self.tickets = StateStore(self.save_tickets_ps, self.setup.get('state_flush_interval_seconds', 0),
+                                  self.checkpoint_path())
         self.devices_ci_map = {}
         self.devices = {}
+        # ServiceNow requests run off the worker thread; their results are collected each cycle
+        snow = self.setup['snow']
+        self.pipeline = TicketPipeline(snow.get('workers', 4), snow.get('requests_per_second'),
+                                       snow.get('burst'), snow.get('max_pending', 1000))
+        # Anomalies cleared while their ticket was still being created
+        self.cancelled = set()
+        # snow.batch: the ticket operations of a cycle are staged and sent as Batch API requests
+        self.snow_batch = None
+        if snow.get('batch'):
+            self.snow_batch = SnowBatch(self.snow_url(), snow['user'], os.environ.get('SNOW_PASS'),
+                                        snow.get('batch_size', 50))
+        self.staged = []
+        self._batches = 0
 
-        self.snow = pysnow.Client(instance=self.setup['snow']['instance'], user=self.setup['snow']['user'],
-                                  password=os.environ.get('SNOW_PASS'))
         self.ps_manager = self.setup['management_property_set']
         self.ps_tickets = self.setup['tickets_property_set']
         self.ps_devices = self.setup['devices_property_set']
 
-        self.incident = self.snow.resource(api_path='/table/incident')
-        self.incident.parameters.display_value = "all"
-        self.load_tickets_ps()
+        self.bp_ids = []
         self.dev_map = {}
-        self.make_devices_map()
-        self.load_devices_ps()
-
-        self.bp_ids = self.get_bp_ids()
+        # Tickets and inventory do not depend on each other: load them side by side. Their first
+        # requests share the client's login.
+        with ThreadPoolExecutor(2, thread_name_prefix="startup") as pool:
+            tickets = pool.submit(startup_profile.run, "SNOWPowerPack tickets", self.load_tickets_ps)
+            inventory = pool.submit(self.load_inventory)
+            tickets.result()
+            inventory.result()
+
+        # Tickets loaded from the property set are closed in the first cycle if their anomaly is gone
+        self.seed_tracker()
+        self.aos_async = self.get_async_apstra_client(self.setup.get('max_concurrent_requests', 8))
+
+    # pysnow is only imported, and the ServiceNow client only built, once a ticket or CI is needed
+    @cached_property
+    def snow(self):
+        import pysnow
+        url = self.setup['snow'].get('url')
+        if url:
+            parsed = urllib.parse.urlparse(url)
+            return pysnow.Client(host=parsed.netloc, use_ssl=parsed.scheme == "https",
+                                 user=self.setup['snow']['user'], password=os.environ.get('SNOW_PASS'))
+        return pysnow.Client(instance=self.setup['snow']['instance'], user=self.setup['snow']['user'],
+                             password=os.environ.get('SNOW_PASS'))
+
+    # snow.url in setup.yaml (e.g. a stand-in server), else the instance's service-now.com address
+    def snow_url(self):
+        return self.setup['snow'].get('url') or f"https://{self.setup['snow']['instance']}.service-now.com"
+
+    @cached_property
+    def incident(self):
+        incident = self.snow.resource(api_path='/table/incident')
+        incident.parameters.display_value = "all"
+        return incident
+
+    # Watched blueprints, their switches and the switches' CIs
+    def load_inventory(self):
+        with startup_profile.phase("SNOWPowerPack blueprints"):
+            self.bp_ids = self.get_bp_ids()
+        with startup_profile.phase("SNOWPowerPack devices"):
+            self.make_devices_map()
+        with startup_profile.phase("SNOWPowerPack device CIs"):
+            self.load_devices_ps()
+
+    # Anomaly changes of one blueprint, diffed while the response streams in
+    async def fetch_blueprint_changes(self, bp_id):
+        if self.aos_client.shares_anomalies():
+            anos = await asyncio.to_thread(self.aos_client.get_shared_anomalies, bp_id)
+            return self.anomaly_tracker.diff(bp_id, anos)
+        anos = await self.aos_async.iter_api_items_if_modified(f"/api/blueprints/{bp_id}/anomalies")
+        if anos is None:
+            return {'added': [], 'changed': [], 'cleared': []}
+        return await self.anomaly_tracker.diff_async(bp_id, anos)
+
+    # Blueprints this process handles: all of them, or the ones leased to its shard
+    def owned_bp_ids(self):
+        if self.shard is None:
+            return self.bp_ids
+        # Tickets move with their blueprint: write out what another shard takes over, pick up what it left
+        acquired, released = self.shard.rebalance(self.bp_ids, self.release_blueprints)
+        if acquired:
+            self.adopt_tickets(acquired)
+        return [b for b in self.bp_ids if b in self.shard.owned]
+
+    # Tickets of blueprints this shard just took over, as their last owner wrote them. Local tickets of
+    # those blueprints are dropped, unless they are changes of this shard's own that were not written
+    # yet (restored from its checkpoint).
+    def adopt_tickets(self, bp_ids):
+        dirty = set(self.tickets.dirty)
+        for a_id in [a_id for a_id, t in self.tickets.items() if t.get('bp_id') in bp_ids and a_id not in dirty]:
+            self.tickets.forget(a_id)
+        self.tickets.load({t['anomaly_id']: t for t in self.read_tickets_ps()
+                           if t.get('bp_id') in bp_ids and t['anomaly_id'] not in dirty})
+        for a_id, t in self.tickets.items():
+            if t.get('bp_id') in bp_ids:
+                self.anomaly_tracker.seed(t['bp_id'], [a_id])
+
+    # Before another shard takes over blueprints: finish the ticket operations in flight, write the tickets
+    # while the blueprints are still owned, then drop them here. Blueprints are kept for a later cycle
+    # when the operations do not finish in time. Blueprints whose lease was already taken over are no
+    # longer owned, so nothing is written for them, and they are dropped either way.
+    def release_blueprints(self, bp_ids, timeout=10):
+        settled = self.settle(timeout)
+        if settled:
+            self.tickets.flush(force=True)
+        else:
+            kept = set(bp_ids) & self.shard.owned
+            logging.warning(f"Ticket operations still running, keeping {len(kept)} blueprints for now")
+            bp_ids = set(bp_ids) - kept
+        for bp_id in bp_ids:
+            self.anomaly_tracker.reset(bp_id)
+            for a_id in [a_id for a_id, t in self.tickets.items() if t.get('bp_id') == bp_id]:
+                self.tickets.forget(a_id)
+        return bp_ids
 
     def worker(self):
-        # pprint.pprint (self.tickets)
-        t1 = self.tickets.copy()
-        for bp_id in self.bp_ids:
-            bp = self.aos_client.get_bp(bp_id.strip())['label']
-            ano = self.aos_client.get_anomalies(bp_id)
-            # print(len(ano))
-            for a in ano:
-                if self.ignore_ano(a):
-                    #print("ignoring")
-                    continue
+        self.collect_tickets()
+        self.refresh_filter()
+        # Only anomalies that appeared, changed or cleared since the last cycle are processed
+        bp_ids = self.owned_bp_ids()
+        results = self.run_async(self.aos_async.fan_out(self.fetch_blueprint_changes, bp_ids))
+        cleared = {}
+        active = False
+        for bp_id, result in zip(bp_ids, results):
+            if isinstance(result, Exception):
+                # Keep the tickets of a blueprint we could not poll instead of closing them
+                logging.error(f"Skipping blueprint {bp_id}: {result}")
+                continue
+            # Label comes from the client's blueprint index instead of downloading the blueprint
+            bp = self.aos_client.get_bp_label(bp_id.strip())
+            changes = result
+            active = active or any(changes.values())
+            for a in self.anomaly_filter.select(changes['added'] + changes['changed'], self.device_hostname,
+                                                bp_id, bp):
                 if not self.tickets.get(a['id']):
-                    tick_id, sys_id = self.make_ticket(self.devices_ci_map[a['identity']['system_id']], a)
-                    self.tickets[a['id']] = {'tick_id': tick_id, 'bp_name': bp, 'bp_id': bp_id,
-                                             'sys_id': sys_id,
-                                             'link': f"{self.snow.base_url}/nav_to.do?uri=incident.do?sys_id={sys_id}",
-                                             'anomaly_id': a['id'],
-                                             'bp_link': f"{self.aos_client.base_url}/#/blueprints/{bp_id}/active/anomalies"
-                                             }
-                else:
-                    #print("Ticket for anomaly already exists : %s" % (self.tickets[a['id']]))
-                    t1.pop(a['id'], None)
-            # break
-        for k in t1.keys():
-            self.tickets.pop(k)
-        self.close_tickets(t1)
-        self.save_tickets_ps(self.tickets)
+                    self.open_ticket(bp_id, bp, a)
+            for a_id in changes['cleared']:
+                t = self.tickets.pop(a_id, None)
+                if t:
+                    cleared[a_id] = t
+                elif self.pipeline.pending(('create', a_id)):
+                    self.cancelled.add(a_id)
+        self.close_tickets(cleared)
+        self.collect_tickets()
+        self.submit_staged()
+        self.tickets.flush()
+        # Anomalies changed or tickets still in flight: keeps an adaptive interval at its floor
+        return active or self.pipeline.pending() > 0
+
+    def watched_bp_ids(self):
+        return [b for b in self.bp_ids if self.shard is None or b in self.shard.owned]
+
+    # Streaming mode: one anomaly change pushed by Apstra
+    def on_anomaly_event(self, kind, event):
+        bp_id = event.get('blueprint_id')
+        if bp_id not in self.bp_ids or (self.shard is not None and bp_id not in self.shard.owned):
+            return
+        a = event['anomaly']
+        self.collect_tickets()
+        if kind == 'cleared':
+            t = self.tickets.pop(a['id'], None)
+            if not t:
+                if self.pipeline.pending(('create', a['id'])):
+                    self.cancelled.add(a['id'])
+                return
+            self.close_tickets({a['id']: t})
+        else:
+            if self.tickets.get(a['id']):
+                return
+            self.refresh_filter()
+            self.handle_anomaly(bp_id, self.aos_client.get_bp_label(bp_id), a)
+        self.submit_staged()
+        self.tickets.flush()
+
+    # Open a ticket for an anomaly unless it already has one or is filtered out
+    def handle_anomaly(self, bp_id, bp, a):
+        if self.tickets.get(a['id']) or self.ignore_ano(a, bp_id, bp):
+            return
+        self.open_ticket(bp_id, bp, a)
+
+    # The ticket is created on the pipeline and recorded by collect_tickets()
+    def open_ticket(self, bp_id, bp, a):
+        # Anomalies of systems without a CI (not in the inventory, or not about a system) get a ticket without one
+        ci = self.devices_ci_map.get((a.get('identity') or {}).get('system_id'))
+        if self.snow_batch:
+            if not self.pipeline.pending(('create', a['id'])):
+                self.staged.append(('create', a['id'], SnowBatch.rest_request(
+                    'POST', "/api/now/table/incident?sysparm_display_value=all", self.ticket_payload(ci, a)),
+                    (bp_id, bp)))
+            return
+        self.pipeline.submit(('create', a['id']), lambda: self.make_ticket(ci, a), context=(bp_id, bp))
+
+    # Submit what is staged and let the pipeline finish, collecting the results until no work is left
+    # (collecting can queue more, e.g. closing a ticket whose anomaly cleared while it was created).
+    # False when operations are still running after `timeout` seconds.
+    def settle(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            if self.snow_batch:
+                self.submit_staged()
+            if not self.pipeline.wait(max(0.0, deadline - time.monotonic())):
+                return False
+            self.collect_tickets()
+            if not self.staged and not self.pipeline.pending():
+                return True
+
+    # Send the operations staged for the Batch API, batch_size per request, each request a pipeline job
+    def submit_staged(self):
+        staged, self.staged = self.staged, []
+        if not staged:
+            return
+        for chunk in self.snow_batch.chunks(staged):
+            self._batches += 1
+            self.pipeline.submit(('batch', self._batches),
+                                 lambda chunk=chunk: self.snow_batch.execute([r for _, _, r, _ in chunk]),
+                                 context=chunk, members=[(op, a_id) for op, a_id, _, _ in chunk])
+
+    # Record the outcome of the ticket operations finished since the last call. A failed create is
+    # retried when the anomaly is next listed, a failed resolve when the tracker next sees it cleared.
+    def collect_tickets(self):
+        for (op, key), context, result, error in self.pipeline.drain():
+            if op != 'batch':
+                self.record_ticket(op, key, context, result, error)
+                continue
+            # One result per batched operation, or the error of the whole batch request for each
+            results = result or [(None, error)] * len(context)
+            for (op, a_id, _, ctx), (record, item_error) in zip(context, results):
+                if op == 'create' and item_error is None:
+                    record = self.ticket_ids(record)
+                self.record_ticket(op, a_id, ctx, record, item_error)
+
+    def record_ticket(self, op, a_id, context, result, error):
+        if op == 'create':
+            bp_id, bp = context
+            if error is not None:
+                self.anomaly_tracker.retry(bp_id, a_id)
+                self.rescan(bp_id)
+                return
+            tick_id, sys_id = result
+            t = {'tick_id': tick_id, 'bp_name': bp, 'bp_id': bp_id,
+                 'sys_id': sys_id,
+                 'link': f"{self.snow_url()}/nav_to.do?uri=incident.do?sys_id={sys_id}",
+                 'anomaly_id': a_id,
+                 'bp_link': f"{self.aos_client.base_url}/#/blueprints/{bp_id}/active/anomalies"
+                 }
+            if a_id in self.cancelled:
+                self.cancelled.discard(a_id)
+                self.close_tickets({a_id: t})
+            else:
+                self.tickets[a_id] = t
+        elif error is not None:
+            self.tickets[a_id] = context
+            if context.get('bp_id'):
+                self.anomaly_tracker.seed(context['bp_id'], [a_id])
+                self.rescan(context['bp_id'])
+
+    # Download the blueprint's anomalies in the next cycle even if they did not change
+    def rescan(self, bp_id):
+        self.aos_async.etags.pop(f"/api/blueprints/{bp_id}/anomalies", None)
 
     # Get pause value
     def get_pause(self):
@@ -66,38 +304,41 @@ class SNOWPowerPack(PowerPackBase):
         return False
 
     # Decide if anomaly needs to be reported
-    def ignore_ano(self, a):
-        ps = self.aos_client.get_property_set(self.ps_manager)['values']
-        a_type = a.get('anomaly_type')
-        a_severity = a.get('severity')
-        a_device = None
-        i = a.get('identity')
-        if i:
-            a_device = self.dev_map.get(i.get('system_id'))['hostname']
-
-        #print(a_type, a_severity, a_device)
-
-        if a_device in ps.get('ignore_devices'):
-            return True
-        if a_type in ps.get('ignore_anomalies'):
-            return True
-        include_only_anomalies = ps.get('include_only_anomalies')
-        if include_only_anomalies:
-            if not (a_type in include_only_anomalies):
-                return True
-        include_only_devices = ps.get('include_only_devices')
-        if include_only_devices:
-            if not(a_device in include_only_devices):
-                return True
-        include_only_severity = ps.get('include_only_severity')
-        if include_only_severity:
-            if not(a_severity in include_only_severity):
-                return True
-
-        return False
+    def ignore_ano(self, a, bp_id=None, bp=None):
+        if self.anomaly_filter is None:
+            self.refresh_filter()
+        return self.anomaly_filter.ignores(a, self.device_hostname, bp_id, bp)
+
+    # Compile the filter rules of the management property set when they changed. Anomalies the old
+    # rules ignored are still known to the anomaly tracker, so it starts over (and the anomaly listings
+    # are downloaded again) to report every current anomaly once more; those with a ticket are skipped.
+    def refresh_filter(self):
+        rules = rules_of(self.aos_client.get_property_set(self.ps_manager).get('values'))
+        if self.anomaly_filter is not None and rules == self.anomaly_filter.rules:
+            return
+        changed = self.anomaly_filter is not None
+        self.anomaly_filter = AnomalyFilter(rules)
+        if changed:
+            logging.info("anomaly filter rules changed, rescanning anomalies")
+            self.anomaly_tracker.reset()
+            self.aos_async.etags.clear()
+            self.seed_tracker()
+
+    # Sharded mode: only the tickets of the blueprints this shard owns
+    def seed_tracker(self):
+        for t in self.tickets.values():
+            if t.get('bp_id') and (self.shard is None or t['bp_id'] in self.shard.owned):
+                self.anomaly_tracker.seed(t['bp_id'], [t['anomaly_id']])
+
+    # Hostname of the anomaly's system, None when it is not in the inventory
+    def device_hostname(self, a):
+        d = self.dev_map.get((a.get('identity') or {}).get('system_id'))
+        return d['hostname'] if d else None
 
     # Saveq Tickets into the Property Set
     def save_tickets_ps(self, ticks):
+        if self.shard is not None:
+            return self.merge_tickets_ps(ticks)
         data = []
         for t in ticks.keys():
             data.append(ticks[t] | {'anomaly_id': t})
@@ -110,6 +351,22 @@ class SNOWPowerPack(PowerPackBase):
             self.aos_client.make_property_set({'label': self.ps_tickets, 'values': values})
         return
 
+    # Sharded mode: the tickets property set is shared by every shard, so under a host-wide lock read
+    # it fresh and replace only the tickets of the blueprints this shard owns
+    def merge_tickets_ps(self, ticks):
+        with self.shard.lock("tickets"):
+            owned = self.shard.owned
+            data = [t for t in self.read_tickets_ps() if t.get('bp_id') not in owned]
+            data += [t | {'anomaly_id': a_id} for a_id, t in ticks.items() if t.get('bp_id') in owned]
+            ps = self.aos_client.get_property_set(self.ps_tickets)
+            self.aos_client.update_property_set(ps['id'],
+                                                {'label': self.ps_tickets, 'values': {'tickets_info': data}})
+
+    # Current tickets property set content, bypassing the cache
+    def read_tickets_ps(self):
+        ps = self.aos_client.get_property_set(self.ps_tickets)
+        return self.aos_client.make_api_request('GET', f"/api/property-sets/{ps['id']}")['values']['tickets_info']
+
     # Find (or create) property set for the device CIS
     def save_devices_ps(self, devs):
         values = {'device_sys_ids': devs}
@@ -122,28 +379,67 @@ class SNOWPowerPack(PowerPackBase):
 
     # Check if there's a property set for device CIS. If none exists, go get CIs (or make them) in ServiceNow
     def load_devices_ps(self):
-        try:
-            ps = self.aos_client.get_property_set(self.ps_devices)
-            self.devices_ci_map = ps.get("values").get("devices_info")
-        except Exception as e:
-            logging.debug("devices property set not found ")
-            self.devices_ci_map = self.make_managed_device_cis()
-            self.aos_client.make_property_set(
-                {'label': self.ps_devices, 'values': {'devices_info': self.devices_ci_map}})
-
-    # Load Tickets from Property Set
+        with self.setup_lock("devices"):
+            try:
+                ps = self.aos_client.get_property_set(self.ps_devices)
+                self.devices_ci_map = ps.get("values").get("devices_info")
+            except Exception as e:
+                logging.debug("devices property set not found ")
+                self.devices_ci_map = self.make_managed_device_cis()
+                self.aos_client.make_property_set(
+                    {'label': self.ps_devices, 'values': {'devices_info': self.devices_ci_map}})
+
+    # Load Tickets from the local checkpoint, or else from the Property Set. In sharded mode a blueprint's
+    # tickets are only loaded once the shard owns it, see adopt_tickets.
     def load_tickets_ps(self):
-        try:
-            ps = self.aos_client.get_property_set(self.ps_tickets)
-        except Exception as e:
-            logging.exception(e)
-            ps = self.aos_client.make_property_set(
-                {'label': self.ps_tickets, 'values': {'tickets_info': []}})
+        if self.tickets.restore():
+            logging.info(f"{len(self.tickets)} tickets restored from {self.tickets.checkpoint_path}")
+            return
+        with self.setup_lock("tickets"):
+            try:
+                ps = self.aos_client.get_property_set(self.ps_tickets)
+            except Exception as e:
+                logging.exception(e)
+                ps = self.aos_client.make_property_set(
+                    {'label': self.ps_tickets, 'values': {'tickets_info': []}})
+        if self.shard is not None:
+            return
         ticks = ps.get("values").get("tickets_info")
-        for t in ticks:
-            self.tickets[t['anomaly_id']] = t
+        self.tickets.load({t['anomaly_id']: t for t in ticks})
         return
 
+    # Sharded mode: one shard at a time runs the first-run setup (CIs, property sets); the others then
+    # find what it made, the property set listing being read again under the lock
+    @contextlib.contextmanager
+    def setup_lock(self, name):
+        if self.shard is None:
+            yield
+            return
+        with self.shard.lock(name):
+            self.aos_client.invalidate_cache("/api/property-sets")
+            yield
+
+    # state_checkpoint_path in setup.yaml; each shard keeps its own file
+    def checkpoint_path(self):
+        path = self.setup.get('state_checkpoint_path')
+        if path and self.shard is not None:
+            path = f"{path}.{self.shard.worker}"
+        return path
+
+    # Finish the ticket operations in flight and write pending ticket changes before stopping. Operations
+    # still queued when the pipeline closes come back cancelled: their tickets are kept, so the next start
+    # retries them.
+    def stop(self, timeout=10):
+        super().stop(timeout)
+        self.settle(timeout)
+        self.pipeline.close(timeout)
+        self.collect_tickets()
+        self.tickets.flush(force=True)
+
+    def metrics_snapshot(self):
+        tickets = self.pipeline.stats() | ({'batch': self.snow_batch.stats()} if self.snow_batch else {})
+        return super().metrics_snapshot() | {'tickets': tickets}
+
     def pretty_print_anomaly(self, ano):
         s = "Error Type : %s\n" % (ano.get('anomaly_type'))
         role = ano.get('role')
@@ -169,62 +465,88 @@ class SNOWPowerPack(PowerPackBase):
         if ps.get('values'):
             bps = ps['values'].get("blueprints")
             if bps:
-                return [self.aos_client.blueprint.get_id_by_name(b.strip()).id for b in bps.split(",")]
+                return [self.aos_client.get_bp_id_by_label(b.strip()) for b in bps.split(",")]
             return ps['values'].get("blueprint_ids")
         return []
 
+    # Resolved on the pipeline; an update is a lookup and a write, hence a cost of 2. With the Batch
+    # API, tickets whose sys_id is known are patched directly instead.
     def close_tickets(self, tickets):
-        for t in tickets.values():
-            self.resolve_ticket(t['tick_id'])
-
+        for a_id, t in tickets.items():
+            # Stopping: kept, and closed in the first cycle of the next start
+            if self.pipeline.closed:
+                self.tickets[a_id] = t
+                continue
+            if self.snow_batch and t.get('sys_id'):
+                self.staged.append(('resolve', a_id, SnowBatch.rest_request(
+                    'PATCH', f"/api/now/table/incident/{t['sys_id']}", RESOLVE_PAYLOAD), t))
+                continue
+            self.pipeline.submit(('resolve', a_id), lambda t=t: self.resolve_ticket(t['tick_id']), cost=2, context=t)
+
+    # Work note and resolution in one update
     def resolve_ticket(self, t):
         #print(f"resolving ticket {t}")
-        self.incident.update({'number': t}, {'work_notes': "Anomaly resolved in Apstra."})
-        response = self.incident.update({'number': t},
-                                        {"close_code": "Resolved By Caller", "state": "6",
-                                         "close_notes": "Closed by API"})
+        response = self.incident.update({'number': t}, RESOLVE_PAYLOAD)
         # print(response)
 
     def make_ticket(self, ci_id, desc):
         # print("making ticket")
         # print(a_id, desc)
-        s = self.pretty_print_anomaly(desc)
+        response = self.incident.create(payload=self.ticket_payload(ci_id, desc))
+        # print(tick_id)
 
-        response = self.incident.create(payload={
-            'short_description': f'Apstra Network Anomaly - {str(desc.get("anomaly_type")).title()} Error ',
-            'cmdb_ci': ci_id
-        })
+        return self.ticket_ids(response.all()[0])
 
-        tick_id = response.all()[0]['number']['value']
-        sys_id = response.all()[0]['sys_id']['value']
-        # print(tick_id)
-        self.incident.update({'number': tick_id}, {'work_notes': s})
+    # The work notes go with the create instead of a separate update
+    def ticket_payload(self, ci_id, desc):
+        return {
+            'short_description': f'Apstra Network Anomaly - {str(desc.get("anomaly_type")).title()} Error ',
+            'cmdb_ci': ci_id,
+            'work_notes': self.pretty_print_anomaly(desc)
+        }
 
-        return tick_id, sys_id
+    # (number, sys_id) of an incident record read with display values
+    @staticmethod
+    def ticket_ids(record):
+        return record['number']['value'], record['sys_id']['value']
 
+    # One CMDB lookup (and create when missing) per device, max_concurrent_requests at a time
     def make_managed_device_cis(self):
         cmdb = self.snow.resource(api_path='/table/cmdb_ci')
-
-        devs = {}
-        for d in self.dev_map:
-            # pprint.pprint(d)
-            r = cmdb.get(query={'name': self.dev_map[d]['hostname']}, stream=True).first_or_none()
-            if r:
-                devs[d] = r['sys_id']
-            else:
-                payload = {'name': self.dev_map[d]['hostname'], "sys_class_name": "cmdb_ci_ip_switch",
-                           'ip_address': self.dev_map[d]['ip_address'], 'mac_address': self.dev_map[d]['mac_address'],
-                           'manufacturer': self.dev_map[d]['manufacturer'], 'model_number': self.dev_map[d]['model_number'],
-                           'serial_number': d}
-
-                r = cmdb.create(payload=payload)
-                devs[d] = r.all()[0]['sys_id']
-
-        return devs
-
+        with ThreadPoolExecutor(self.setup.get('max_concurrent_requests', 8), thread_name_prefix="cmdb") as pool:
+            return dict(zip(self.dev_map, pool.map(lambda d: self.find_or_make_ci(cmdb, d), self.dev_map)))
+
+    def find_or_make_ci(self, cmdb, d):
+        r = cmdb.get(query={'name': self.dev_map[d]['hostname']}, stream=True).first_or_none()
+        if r:
+            return r['sys_id']
+        payload = {'name': self.dev_map[d]['hostname'], "sys_class_name": "cmdb_ci_ip_switch",
+                   'ip_address': self.dev_map[d]['ip_address'], 'mac_address': self.dev_map[d]['mac_address'],
+                   'manufacturer': self.dev_map[d]['manufacturer'], 'model_number': self.dev_map[d]['model_number'],
+                   'serial_number': d}
+
+        r = cmdb.create(payload=payload)
+        return r.all()[0]['sys_id']
+
+    # Only the switches of the watched blueprints, found with graph queries. /api/systems is still read
+    # in one streamed request; the graph tells which of its systems to keep.
     def make_devices_map(self):
-        devs = self.aos_client.make_api_request("GET", "/api/systems/")['items']
-        for d in devs:
+        ids = set()
+        for bp_id in self.bp_ids:
+            if not bp_id:
+                continue
+            try:
+                rows = self.aos_client.get_blueprint_systems(bp_id)
+            except Exception as e:
+                logging.error(f"No switches for blueprint {bp_id}: {e}")
+                continue
+            if rows is None:
+                ids = None
+                break
+            ids.update(r.system_id for r in rows)
+        for d in self.aos_client.iter_systems():
+            if ids is not None and d['id'] not in ids:
+                continue
             self.dev_map[d['facts']['serial_number']] = {
                 "hostname": d["status"]["hostname"],
                 "ip_address": d["facts"]["mgmt_ipaddr"],
@@ -233,7 +555,12 @@ class SNOWPowerPack(PowerPackBase):
                 "model_number": d["facts"]["hw_model"]
             }
 
-
 if __name__ == '__main__':
-    pp = SNOWPowerPack()
-    pp.start_threads(blocking=True)
+    # With a shards section in setup.yaml the blueprints are split across several processes
+    from sharding import ShardedRunner
+    runner = ShardedRunner.from_setup(SNOWPowerPack)
+    if runner:
+        runner.run()
+    else:
+        pp = SNOWPowerPack()
+        pp.start_threads(blocking=True)
@@ -0,0 +1 @@
+../power_pack/state_store.py
\ No newline at end of file
@@ -0,0 +1,143 @@
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# Allows `rate` requests per second on average with bursts of up to `burst`. acquire() blocks the
+# calling thread until enough tokens are available.
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1, rate)
+        self.tokens = self.capacity
+        self.waited = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, n=1):
+        n = min(n, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return
+                delay = (n - self.tokens) / self.rate
+                self.waited += delay
+            time.sleep(delay)
+
+
+# Runs ticket operations (ServiceNow requests) on a bounded pool of threads, under an optional rate
+# limit, so the worker cycle does not wait for ServiceNow. Jobs are keyed: a key is only queued once
+# until its result has been taken. Results are collected with drain() on the caller's thread, which
+# keeps the ticket state single threaded.
+class TicketPipeline:
+    def __init__(self, workers=4, rate=None, burst=None, max_pending=1000):
+        self.limiter = TokenBucket(rate, burst) if rate else None
+        self.submitted = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.closed = False
+        self._jobs = queue.Queue(max_pending)
+        self._results = queue.Queue()
+        self._pending = set()
+        self._members = {}
+        self._lock = threading.Lock()
+        self._threads = [threading.Thread(target=self.run, name=f"tickets-{i}", daemon=True) for i in range(workers)]
+        for t in self._threads:
+            t.start()
+
+    # fn() runs on a pipeline thread after taking `cost` tokens (the HTTP requests it makes).
+    # members: keys of the operations a combined job (e.g. a batch request) carries out, pending
+    # along with it. Blocks while max_pending jobs are queued. False while the key is still pending, and
+    # once the pipeline is closed.
+    def submit(self, key, fn, cost=1, context=None, members=()):
+        with self._lock:
+            if self.closed or key in self._pending:
+                return False
+            self._pending.add(key)
+            self._members[key] = tuple(members)
+            self._pending.update(members)
+            self.submitted += 1
+        self._jobs.put((key, fn, cost, context))
+        return True
+
+    # Wait up to `timeout` seconds for the queued and running jobs to finish. False on timeout.
+    def wait(self, timeout=None):
+        with self._jobs.all_tasks_done:
+            return self._jobs.all_tasks_done.wait_for(lambda: not self._jobs.unfinished_tasks, timeout)
+
+    def pending(self, key=None):
+        with self._lock:
+            return key in self._pending if key is not None else len(self._pending)
+
+    def run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                self._jobs.task_done()
+                return
+            key, fn, cost, context = job
+            if self.limiter:
+                self.limiter.acquire(cost)
+            try:
+                result, error = fn(), None
+            except Exception as e:
+                logger.exception(f"Ticket operation {key} failed: {e}")
+                result, error = None, e
+            if error is not None:
+                with self._lock:
+                    self.failed += 1
+            self._results.put((key, context, result, error))
+            self._jobs.task_done()
+
+    # (key, context, result, error) of the jobs finished since the last call. A key stays pending
+    # until its result is taken here.
+    def drain(self):
+        while True:
+            try:
+                item = self._results.get_nowait()
+            except queue.Empty:
+                return
+            with self._lock:
+                self._pending.discard(item[0])
+                self._pending.difference_update(self._members.pop(item[0], ()))
+            yield item
+
+    # Let the queued jobs run for up to `timeout` seconds, then cancel those still queued (their result
+    # is an error, collected with drain() as usual) and stop the threads
+    def close(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            self.closed = True
+        self.wait(timeout)
+        while True:
+            try:
+                job = self._jobs.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None:
+                key, _, _, context = job
+                with self._lock:
+                    self.cancelled += 1
+                self._results.put((key, context, None, Exception("Cancelled: ticket pipeline closed")))
+            self._jobs.task_done()
+        # The queue is empty now, so the sentinels only wait on a submit that was already blocked
+        for _ in self._threads:
+            try:
+                self._jobs.put(None, timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Full:
+                break
+        for t in self._threads:
+            t.join(max(0.0, deadline - time.monotonic()))
+
+    def stats(self):
+        with self._lock:
+            return {'submitted': self.submitted, 'failed': self.failed, 'cancelled': self.cancelled,
+                    'pending': len(self._pending),
+                    'throttled_seconds': self.limiter.waited if self.limiter else 0.0}
@@ -0,0 +1 @@
+../power_pack/tracing.py
\ No newline at end of file
@@ -1,29 +1,578 @@
+import copy
+import decimal
+import hashlib
 import json
 import logging
 import os
+import pickle
 import pprint
+import re
+import threading
+import time
+import urllib.parse
+from collections import defaultdict, namedtuple
+from concurrent.futures import Future
+from functools import lru_cache
 
 import requests
 import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+# ijson 2, which pysnow pins, has no use_float: its Decimals are converted to floats as items come out
+IJSON_USE_FLOAT = ijson is not None and int(ijson.__version__.split('.')[0]) >= 3
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 logger = logging.getLogger(__name__)
 
+# Seconds a cached GET stays valid, per resource
+DEFAULT_CACHE_TTLS = {
+    'property_sets': 10,
+    'blueprints': 30,
+    'probes': 300,
+}
+
+OOS_STAGE_NAME = "Is Out of Sequence Packets Detected?"
+
+# Anomaly fields a query can scope on: top level or inside 'identity'
+ANOMALY_IDENTITY_FIELDS = ('probe_label', 'stage_name', 'system_id')
+
+
+# Upper bounds (seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Path segments following these collections are ids and are folded into {id} for metrics
+ID_COLLECTIONS = ('blueprints', 'property-sets', 'load-balancing-policies', 'tasks', 'probes', 'systems',
+                  'streaming-config', 'stages')
+ID_SEGMENT = re.compile(r"(/(?:%s)/)[^/?]+" % "|".join(re.escape(c) for c in ID_COLLECTIONS))
+
+
+# Numbers as json.loads reads them: ijson 2 gives Decimal for anything that is not an integer
+def decimals_to_floats(value):
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, dict):
+        return {k: decimals_to_floats(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [decimals_to_floats(v) for v in value]
+    return value
+
+
+# /api/blueprints/4f1c.../anomalies?x=y -> /api/blueprints/{id}/anomalies
+def endpoint_template(endpoint):
+    return ID_SEGMENT.sub(r"\1{id}", endpoint.split('?', 1)[0])
+
+
+# Per-endpoint latency histograms, status counters and bytes transferred for one client.
+# Calls are also counted per thread so a pack can tell how many requests one cycle made.
+class ClientMetrics:
+    def __init__(self):
+        self.endpoints = {}
+        self.statuses = defaultdict(int)
+        self.relogins = 0
+        self.listeners = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    # fn(method, endpoint, status, seconds) is called after every recorded request, on the thread that
+    # made it, e.g. to trace the requests of one cycle
+    def add_listener(self, fn):
+        self.listeners.append(fn)
+
+    def remove_listener(self, fn):
+        if fn in self.listeners:
+            self.listeners.remove(fn)
+
+    def record(self, method, endpoint, status, seconds, bytes_in=0, bytes_out=0):
+        key = (method, endpoint_template(endpoint))
+        with self._lock:
+            e = self.endpoints.get(key)
+            if e is None:
+                e = self.endpoints[key] = {'count': 0, 'seconds': 0.0, 'buckets': [0] * len(LATENCY_BUCKETS),
+                                           'bytes_in': 0, 'bytes_out': 0}
+            e['count'] += 1
+            e['seconds'] += seconds
+            e['bytes_in'] += bytes_in
+            e['bytes_out'] += bytes_out
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    e['buckets'][i] += 1
+            self.statuses[key + (status,)] += 1
+        self._local.calls = self.thread_calls() + 1
+        for fn in self.listeners:
+            fn(method, endpoint, status, seconds)
+
+    def record_relogin(self):
+        with self._lock:
+            self.relogins += 1
+
+    # Requests made so far by the calling thread
+    def thread_calls(self):
+        return getattr(self._local, 'calls', 0)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'endpoints': [{'method': m, 'endpoint': ep} | {k: (list(v) if k == 'buckets' else v) for k, v in e.items()}
+                              for (m, ep), e in self.endpoints.items()],
+                'statuses': [{'method': m, 'endpoint': ep, 'status': st, 'count': c}
+                             for (m, ep, st), c in self.statuses.items()],
+                'relogins': self.relogins,
+                'buckets': list(LATENCY_BUCKETS),
+            }
+
+
+# Kept bodies are stored pickled and every caller gets its own copy, so a caller editing what it got
+# (e.g. a policy before writing it back) does not change what the next caller reads
+def freeze(body):
+    return pickle.dumps(body, pickle.HIGHEST_PROTOCOL)
+
+
+def thaw(frozen):
+    return pickle.loads(frozen)
+
+
+# Thread-safe TTL cache of GET responses keyed by endpoint.
+# Entries are dropped when they expire or when a write invalidates their endpoint.
+class ResponseCache:
+    def __init__(self, ttls):
+        self.ttls = ttls
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def enabled(self, resource):
+        return bool(self.ttls.get(resource))
+
+    def get(self, resource, endpoint):
+        with self._lock:
+            entry = self._entries.get(endpoint)
+            if entry and entry[0] > time.monotonic():
+                self.hits[resource] += 1
+                frozen = entry[1]
+            else:
+                self._entries.pop(endpoint, None)
+                self.misses[resource] += 1
+                return None
+        return thaw(frozen)
+
+    def put(self, resource, endpoint, value):
+        frozen = freeze(value)
+        with self._lock:
+            self._entries[endpoint] = (time.monotonic() + self.ttls[resource], frozen)
+
+    # Drop the endpoint and everything below it (sub-resources and query variants)
+    def invalidate(self, endpoint):
+        with self._lock:
+            for k in [k for k in self._entries
+                      if k == endpoint or k.startswith(endpoint + '/') or k.startswith(endpoint + '?')]:
+                del self._entries[k]
+
+    # Drop exactly this endpoint
+    def discard(self, endpoint):
+        with self._lock:
+            self._entries.pop(endpoint, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {r: {'hits': self.hits[r], 'misses': self.misses[r], 'ttl': self.ttls[r]} for r in self.ttls} | \
+                {'entries': len(self._entries)}
+
+
+# label -> id and id -> object lookups over one collection, refreshed from each listing. The index keeps
+# its own copies and hands out copies, so callers can modify what they get.
+class LabelIndex:
+    def __init__(self):
+        self.ids_by_label = {}
+        self.objects_by_id = {}
+        self._listing = None
+        self._lock = threading.Lock()
+
+    # Apply a listing: add or replace what came back and drop what disappeared.
+    # A listing equal to the last one applied (e.g. another copy of a cached listing) is skipped.
+    def update(self, items):
+        with self._lock:
+            if items == self._listing:
+                return
+            items = copy.deepcopy(items)
+            self._listing = items
+            seen = set()
+            for item in items:
+                seen.add(item['id'])
+                self._put(item)
+            for gone in self.objects_by_id.keys() - seen:
+                self._remove(gone)
+
+    def put(self, item):
+        with self._lock:
+            self._put(copy.deepcopy(item))
+
+    def remove(self, obj_id):
+        with self._lock:
+            self._remove(obj_id)
+
+    def id_for(self, label):
+        return self.ids_by_label.get(label)
+
+    def get(self, obj_id):
+        return copy.deepcopy(self.objects_by_id.get(obj_id))
+
+    def _put(self, item):
+        old = self.objects_by_id.get(item['id'])
+        if old is not None and old.get('label') != item.get('label'):
+            self.ids_by_label.pop(old.get('label'), None)
+        self.objects_by_id[item['id']] = item
+        self.ids_by_label[item.get('label')] = item['id']
+
+    def _remove(self, obj_id):
+        old = self.objects_by_id.pop(obj_id, None)
+        if old is not None and self.ids_by_label.get(old.get('label')) == obj_id:
+            del self.ids_by_label[old.get('label')]
+
+
+# Last anomaly snapshot per key (usually a blueprint id) as anomaly id -> content hash.
+# diff() turns a fresh listing into added / changed / cleared events; only the hashes are kept.
+class AnomalyTracker:
+    def __init__(self):
+        self._snapshots = {}
+        # Keys with anomalies to report again, whose next listing has to be downloaded even if unchanged
+        self._stale = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def content_hash(a):
+        return hashlib.blake2b(json.dumps(a, sort_keys=True, default=str).encode(), digest_size=16).digest()
+
+    # Start from already known anomaly ids (e.g. persisted tickets) so that they are reported as
+    # cleared when they are gone and as changed when they are still there
+    def seed(self, key, anomaly_ids):
+        with self._lock:
+            snapshot = self._snapshots.setdefault(key, {})
+            for i in anomaly_ids:
+                snapshot.setdefault(i, None)
+            self._stale.add(key)
+
+    # Report an anomaly again (as changed) in the next diff, e.g. after failing to act on it
+    def retry(self, key, anomaly_id):
+        with self._lock:
+            snapshot = self._snapshots.get(key)
+            if snapshot is not None and anomaly_id in snapshot:
+                snapshot[anomaly_id] = None
+                self._stale.add(key)
+
+    def reset(self, key=None):
+        with self._lock:
+            if key is None:
+                self._snapshots.clear()
+                self._stale.clear()
+            else:
+                self._snapshots.pop(key, None)
+                self._stale.discard(key)
+
+    # True when an unchanged listing (a 304) would not do: nothing is known yet, or ids were seeded
+    # or are to be retried
+    def needs_listing(self, key):
+        with self._lock:
+            return key in self._stale or key not in self._snapshots
+
+    # anomalies may be any iterable, including a streamed response; it is consumed once
+    def diff(self, key, anomalies):
+        old, new, changes = self.begin(key)
+        for a in anomalies:
+            self.feed(old, new, changes, a)
+        return self.finish(key, old, new, changes)
+
+    # Same as diff() for an async iterable such as AsyncApstraClient.iter_anomalies()
+    async def diff_async(self, key, anomalies):
+        old, new, changes = self.begin(key)
+        async for a in anomalies:
+            self.feed(old, new, changes, a)
+        return self.finish(key, old, new, changes)
+
+    def begin(self, key):
+        with self._lock:
+            old = self._snapshots.get(key, {})
+        return old, {}, {'added': [], 'changed': [], 'cleared': []}
+
+    def feed(self, old, new, changes, a):
+        h = self.content_hash(a)
+        new[a['id']] = h
+        if a['id'] not in old:
+            changes['added'].append(a)
+        elif old[a['id']] != h:
+            changes['changed'].append(a)
+
+    # The snapshot is only replaced once the whole listing has been consumed
+    def finish(self, key, old, new, changes):
+        changes['cleared'] = [i for i in old if i not in new]
+        with self._lock:
+            self._snapshots[key] = new
+            self._stale.discard(key)
+        return changes
+
+
+# Collects changes staged against a blueprint for `window` seconds, applies them in order and
+# deploys once. A change is a callable taking the client and returning the deploy comment (or None);
+# staging again under the same key replaces the pending change. With no window every stage flushes.
+class DeployBatcher:
+    def __init__(self, client, window=0):
+        self.client = client
+        self.window = window
+        self.deploys = 0
+        self.changes = 0
+        self._pending = {}
+        self._timers = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def stage(self, bp_id, key, change):
+        with self._lock:
+            self._pending.setdefault(bp_id, {})[key] = change
+            if self.window and bp_id not in self._timers:
+                timer = threading.Timer(self.window, self.flush, args=(bp_id,))
+                timer.daemon = True
+                self._timers[bp_id] = timer
+                timer.start()
+        if not self.window:
+            self.flush(bp_id)
+
+    def flush(self, bp_id=None):
+        with self._flush_lock:
+            with self._lock:
+                bp_ids = [bp_id] if bp_id else list(self._pending)
+            for b in bp_ids:
+                with self._lock:
+                    changes = self._pending.pop(b, {})
+                    timer = self._timers.pop(b, None)
+                if timer:
+                    timer.cancel()
+                comments = []
+                for key, change in changes.items():
+                    try:
+                        comments.append(change(self.client))
+                        self.changes += 1
+                    except Exception as e:
+                        logger.exception(f"Staged change {key} on blueprint {b} failed: {e}")
+                if comments:
+                    self.client.deploy_blueprint(b, "; ".join(c for c in comments if c) or "Batched changes")
+                    self.deploys += 1
+
+    # Whether changes are waiting for their deploy
+    def pending(self, bp_id=None):
+        with self._lock:
+            return bool(self._pending.get(bp_id) if bp_id else any(self._pending.values()))
+
+    def stats(self):
+        return {'changes': self.changes, 'deploys': self.deploys}
+
+
+# A graph (QE) query ready to send: its text, the name its matches are returned under and the
+# namedtuple type result rows are built as
+GraphQuery = namedtuple('GraphQuery', ['text', 'name', 'row'])
+
+
+# Queries are compiled once per (node type, fields, filter) and reused from then on
+@lru_cache(maxsize=256)
+def compile_graph_query(node_type, fields, where=()):
+    args = ", ".join([repr(node_type), f"name={node_type!r}"] + [f"{k}={v!r}" for k, v in where])
+    row = namedtuple("".join(w.title() for w in node_type.split('_')) + "Row", fields)
+    return GraphQuery(f"match(node({args}))", node_type, row)
+
+
+# Validators (ETag / Last-Modified), bodies and blueprint versions of conditionally fetched resources.
+# Bodies are kept frozen, see thaw().
+class ConditionalStore:
+    def __init__(self, version_probe_ttl=2):
+        self.version_probe_ttl = version_probe_ttl
+        self.not_modified = 0
+        self.version_hits = 0
+        self.fetched = 0
+        self._entries = {}
+        self._probes = {}
+        self._lock = threading.Lock()
+
+    def get(self, endpoint):
+        return self._entries.get(endpoint)
+
+    # Validators of an entry as request headers
+    @staticmethod
+    def headers(entry):
+        headers = {}
+        if entry and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def put(self, endpoint, response_headers, body, version):
+        frozen = freeze(body)
+        with self._lock:
+            self.fetched += 1
+            self._entries[endpoint] = {'etag': response_headers.get('ETag'),
+                                       'last_modified': response_headers.get('Last-Modified'),
+                                       'body': frozen, 'version': version}
+
+    def discard(self, endpoint):
+        with self._lock:
+            self._entries.pop(endpoint, None)
+
+    # After a 304: new validators and version for the body already kept
+    def refresh(self, endpoint, response_headers, version):
+        with self._lock:
+            entry = self._entries.get(endpoint)
+            if entry is not None:
+                self._entries[endpoint] = entry | {'etag': response_headers.get('ETag', entry['etag']),
+                                                   'last_modified': response_headers.get('Last-Modified',
+                                                                                         entry['last_modified']),
+                                                   'version': version}
+
+    def probed_version(self, bp_id):
+        probe = self._probes.get(bp_id)
+        if probe and probe[0] > time.monotonic():
+            return probe[1]
+        return None
+
+    def put_probe(self, bp_id, version):
+        with self._lock:
+            self._probes[bp_id] = (time.monotonic() + self.version_probe_ttl, version)
+
+    # Our own writes move the blueprint version
+    def forget_probe(self, bp_id):
+        with self._lock:
+            self._probes.pop(bp_id, None)
+
+    def stats(self):
+        return {'not_modified': self.not_modified, 'version_hits': self.version_hits, 'fetched': self.fetched,
+                'entries': len(self._entries)}
+
+
+# Single-flight GETs: a caller asking for a key that is already being fetched waits for that fetch
+# instead of sending a duplicate request. Each waiter gets its own copy of the result.
+class InflightRequests:
+    def __init__(self):
+        self.sent = 0
+        self.coalesced = defaultdict(int)
+        # key -> [Future, number of waiters]
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, endpoint, fetch):
+        with self._lock:
+            entry = self._inflight.get(key)
+            leader = entry is None
+            if leader:
+                entry = self._inflight[key] = [Future(), 0]
+                self.sent += 1
+            else:
+                entry[1] += 1
+                self.coalesced[endpoint_template(endpoint)] += 1
+        future = entry[0]
+        if not leader:
+            return thaw(future.result())
+        try:
+            result = fetch()
+        except BaseException as e:
+            self.done(key, entry)
+            future.set_exception(e)
+            raise
+        # Nobody can join once the entry is gone, so the waiters counted by then are all there are
+        waiters = self.done(key, entry)
+        future.set_result(freeze(result) if waiters else None)
+        return result
+
+    def done(self, key, entry):
+        with self._lock:
+            if self._inflight.get(key) is entry:
+                del self._inflight[key]
+            return entry[1]
+
+    # After a write, later callers must not join a GET that started before it
+    def detach(self):
+        with self._lock:
+            self._inflight.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'sent': self.sent, 'coalesced': sum(self.coalesced.values()),
+                    'endpoints': dict(self.coalesced), 'in_flight': len(self._inflight)}
+
 
 class ApstraClient:
-    def __init__(self, base_url, username, port, password, ssl_verify):
+    # defer_login: log in on the first request instead of here, so the caller can do other startup
+    # work meanwhile. Concurrent first requests share one login.
+    def __init__(self, base_url, username, port, password, ssl_verify, pool_size=10, retries=3,
+                 backoff_factor=0.5, defer_login=False):
         self.auth_token = None
         self.base_url = base_url
         self.username = username
         self.password = password
         self.port = port
         self.ssl_verify = ssl_verify
-        self.login()
+        self._login_lock = threading.Lock()
+        self.metrics = ClientMetrics()
+        self.session = self.make_session(pool_size, retries, backoff_factor)
+        self.cache = None
+        self.conditional = None
+        # Validators of the listings read by iter_api_items_if_modified, by endpoint
+        self.feed_validators = {}
+        self.inflight = InflightRequests()
+        self.bp_index = LabelIndex()
+        self.ps_index = LabelIndex()
+        self.probe_indexes = defaultdict(LabelIndex)
+        self.anomaly_tracker = AnomalyTracker()
+        self.staging_versions = {}
+        self.anomaly_query_params = True
+        self.probe_anomalies = True
+        self.graph_queries = True
+        if not defer_login:
+            self.login()
+
+    # Opt in to caching GETs of property sets and blueprint metadata.
+    # ttls is either one number of seconds for every resource or a dict of resource -> seconds; only the
+    # resources in the dict are cached.
+    def configure_cache(self, ttls=None):
+        if ttls is None:
+            ttls = DEFAULT_CACHE_TTLS
+        elif not isinstance(ttls, dict):
+            ttls = {r: ttls for r in DEFAULT_CACHE_TTLS}
+        self.cache = ResponseCache(dict(ttls))
+
+    def cache_stats(self):
+        return self.cache.stats() if self.cache else {}
+
+    def invalidate_cache(self, endpoint):
+        if self.cache:
+            self.cache.invalidate(endpoint)
+
+    # One pooled keep-alive session shared by every thread using this client.
+    # Idempotent requests are retried with backoff on connection errors and transient 5xx.
+    def make_session(self, pool_size, retries, backoff_factor):
+        retry = Retry(total=retries, connect=retries, read=retries, status=retries,
+                      backoff_factor=backoff_factor, status_forcelist=(500, 502, 503, 504),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        session = requests.Session()
+        session.verify = self.ssl_verify
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def close(self):
+        self.session.close()
 
     def login(self):
         try:
-            response = requests.post(
-                f"{self.base_url.rstrip('/')}:{self.port}/api/aaa/login",
+            response = self.timed_request(
+                'POST', "/api/aaa/login",
                 json={
                     "username": self.username,
                     "password": self.password
@@ -42,31 +591,66 @@ class ApstraClient:
             logger.exception(f"Failed to get auth token: {str(e)}")
             return
 
+    # Single-flight token refresh. Threads that got a 401 with the same stale token wait on
+    # the lock; only the first one logs in, the rest pick up the token it obtained.
+    def refresh_token(self, stale_token):
+        with self._login_lock:
+            if self.auth_token == stale_token:
+                if stale_token:
+                    self.metrics.record_relogin()
+                self.login()
+            return self.auth_token
+
+    # Token to send, logging in first when the client was created with defer_login
+    def ensure_login(self):
+        return self.auth_token or self.refresh_token(None)
+
+    # One HTTP exchange, recorded in the client metrics
+    def timed_request(self, method, endpoint, **kwargs):
+        url = f"{self.base_url.rstrip('/')}:{self.port}{endpoint}"
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method=method, url=url, **kwargs)
+        except Exception:
+            self.metrics.record(method, endpoint, 'error', time.perf_counter() - start)
+            raise
+        if kwargs.get('stream'):
+            bytes_in = int(response.headers.get('Content-Length') or 0)
+        else:
+            bytes_in = len(response.content)
+        bytes_out = len(response.request.body or b'') if response.request is not None else 0
+        self.metrics.record(method, endpoint, response.status_code, time.perf_counter() - start, bytes_in, bytes_out)
+        return response
+
+    def send_request(self, method, endpoint, data=None, headers=None, **kwargs):
+        token = self.ensure_login()
+        response = self.timed_request(method, endpoint, json=data, headers={'authtoken': token} | (headers or {}),
+                                      **kwargs)
+
+        if response.status_code == 401:
+            response.close()
+            token = self.refresh_token(token)
+            if token:
+                response = self.timed_request(method, endpoint, json=data,
+                                              headers={'authtoken': token} | (headers or {}), **kwargs)
+        response.raise_for_status()
+        return response
+
+    def metrics_snapshot(self):
+        return self.metrics.snapshot() | {'cache': self.cache_stats(), 'coalescing': self.inflight.stats(),
+                                          'conditional': self.conditional.stats() if self.conditional else {}}
+
     def make_api_request(self, method, endpoint, data=None):
+        if method == 'GET':
+            return self.inflight.run(endpoint, endpoint, lambda: self.fetch_json(method, endpoint, data))
         try:
-            url = f"{self.base_url.rstrip('/')}:{self.port}{endpoint}"
-            # print(url)
-            headers = {'authtoken': self.auth_token}
-            response = requests.request(
-                method=method,
-                url=url,
-                json=data,
-                headers=headers,
-                verify=self.ssl_verify
-            )
+            return self.fetch_json(method, endpoint, data)
+        finally:
+            self.inflight.detach()
 
-            if response.status_code == 401:
-                self.login()
-                if self.auth_token:
-                    headers = {'authtoken': self.auth_token}
-                    response = requests.request(
-                        method=method,
-                        url=url,
-                        data=data,
-                        headers=headers,
-                        verify=self.ssl_verify
-                    )
-            response.raise_for_status()
+    def fetch_json(self, method, endpoint, data=None):
+        try:
+            response = self.send_request(method, endpoint, data)
             if response.text.strip()=="":
                 return {}
             else:
@@ -75,6 +659,127 @@ class ApstraClient:
             logger.exception(f"API request failed: {str(e)}")
             raise
 
+    # Yield the elements of a collection response one at a time while the body is still being read,
+    # so peak memory does not grow with the collection. Without ijson installed the body is decoded
+    # in one piece and then iterated.
+    def iter_api_items(self, endpoint, path='items'):
+        try:
+            response = self.send_request('GET', endpoint, stream=True)
+        except Exception as e:
+            logger.exception(f"API request failed: {str(e)}")
+            raise
+        yield from self.iter_response_items(response, path)
+
+    def iter_response_items(self, response, path, on_complete=None):
+        try:
+            if ijson is None:
+                body = response.json() if response.text.strip() else {}
+                yield from body.get(path, [])
+            else:
+                response.raw.decode_content = True
+                if IJSON_USE_FLOAT:
+                    yield from ijson.items(response.raw, f"{path}.item", use_float=True)
+                else:
+                    yield from map(decimals_to_floats, ijson.items(response.raw, f"{path}.item"))
+            if on_complete:
+                on_complete()
+        finally:
+            response.close()
+
+    # Streamed collection, or None when the server says it has not changed since the last time it
+    # was consumed completely. Conditional fetching has to be enabled. The validators are kept apart
+    # from the ConditionalStore: a 304 here means "nothing new for this feed", which must not answer
+    # a conditional_request of the same endpoint (that needs the body), nor the other way round.
+    def iter_api_items_if_modified(self, endpoint, path='items'):
+        if self.conditional is None:
+            return self.iter_api_items(endpoint, path)
+        try:
+            response = self.send_request('GET', endpoint, headers=self.feed_validators.get(endpoint), stream=True)
+        except Exception as e:
+            logger.exception(f"API request failed: {str(e)}")
+            raise
+        if response.status_code == 304:
+            response.close()
+            self.conditional.not_modified += 1
+            return None
+        validators = {h: response.headers[v] for h, v in (('If-None-Match', 'ETag'),
+                                                          ('If-Modified-Since', 'Last-Modified'))
+                      if response.headers.get(v)}
+        # Validators are only kept once the whole listing has been consumed
+        return self.iter_response_items(response, path,
+                                        lambda: self.feed_validators.__setitem__(endpoint, validators))
+
+    # Opt in to conditional GETs: ETag / Last-Modified validators per resource, plus a cheap blueprint
+    # version probe (/diff-status) for blueprint configuration, so unchanged payloads are not downloaded
+    def configure_conditional(self, version_probe_ttl=2):
+        self.conditional = ConditionalStore(version_probe_ttl)
+
+    # Current staging version of a blueprint, probed at most every version_probe_ttl seconds
+    def get_blueprint_version(self, bp_id):
+        version = self.conditional.probed_version(bp_id)
+        if version is None:
+            version = self.make_api_request('GET', f"/api/blueprints/{bp_id}/diff-status")['staging_version']
+            self.conditional.put_probe(bp_id, version)
+        return version
+
+    # GET that returns the remembered body instead of downloading it again when the resource is known
+    # to be unchanged: for `versioned` blueprint resources when the blueprint version has not moved,
+    # otherwise when the server answers 304 to the stored validators
+    def conditional_request(self, endpoint, bp_id=None, versioned=False):
+        if self.conditional is None:
+            return self.make_api_request('GET', endpoint)
+        version = None
+        entry = self.conditional.get(endpoint)
+        if versioned and bp_id:
+            try:
+                version = self.get_blueprint_version(bp_id)
+            except Exception:
+                version = None
+            if entry and version is not None and entry['version'] == version:
+                self.conditional.version_hits += 1
+                return thaw(entry['body'])
+        return self.inflight.run(('conditional', endpoint), endpoint,
+                                 lambda: self.fetch_conditional(endpoint, version))
+
+    # The validators sent and the body a 304 answers with come from the same entry, read when the request
+    # goes out. A body is only kept when there is something to check it against next time: a validator
+    # from the server, or the blueprint version.
+    def fetch_conditional(self, endpoint, version):
+        entry = self.conditional.get(endpoint)
+        try:
+            response = self.send_request('GET', endpoint, headers=self.conditional.headers(entry))
+            if response.status_code == 304 and entry:
+                self.conditional.not_modified += 1
+                self.conditional.refresh(endpoint, response.headers, version)
+                return thaw(entry['body'])
+            if response.status_code == 304:
+                response = self.send_request('GET', endpoint)
+            body = response.json() if response.text.strip() else {}
+        except Exception as e:
+            logger.exception(f"API request failed: {str(e)}")
+            raise
+        if version is not None or response.headers.get('ETag') or response.headers.get('Last-Modified'):
+            self.conditional.put(endpoint, response.headers, body, version)
+        else:
+            self.conditional.fetched += 1
+            self.conditional.discard(endpoint)
+        return body
+
+    # GET through the cache when caching is enabled for this resource
+    def cached_request(self, resource, endpoint):
+        if not (self.cache and self.cache.enabled(resource)):
+            return self.make_api_request('GET', endpoint)
+        response = self.cache.get(resource, endpoint)
+        if response is None:
+            # Filled while still in flight, so a caller arriving right after the fetch finds the entry
+            response = self.inflight.run(endpoint, endpoint, lambda: self.fetch_cached(resource, endpoint))
+        return response
+
+    def fetch_cached(self, resource, endpoint):
+        response = self.fetch_json('GET', endpoint)
+        self.cache.put(resource, endpoint, response)
+        return response
+
     def get_task_details(self, blueprint_id, task_id):
         """Get detailed task info"""
         try:
@@ -103,12 +808,78 @@ class ApstraClient:
         except Exception as e:
             logger.exception(e)
 
-    def get_anomalies(self, blueprint_id):
+    def iter_anomalies(self, blueprint_id):
+        return self.iter_api_items(f"/api/blueprints/{blueprint_id}/anomalies")
+
+    def iter_systems(self):
+        return self.iter_api_items("/api/systems/")
+
+    # Nodes of one type in a blueprint's graph, filtered on their attributes by the server, as rows
+    # holding only `fields`. Returns None when the controller does not take graph queries, so callers
+    # can fall back to the REST collections. With conditional fetching, results are kept until the
+    # blueprint version changes.
+    def graph_nodes(self, bp_id, node_type, fields, **where):
+        if not bp_id:
+            raise ValueError(f"No blueprint id for a {node_type} graph query")
+        if not self.graph_queries:
+            return None
+        query = compile_graph_query(node_type, tuple(fields), tuple(sorted(where.items())))
+        endpoint = f"/api/blueprints/{bp_id}/qe"
+        key = f"{endpoint}?{query.text}"
+        version = None
+        if self.conditional is not None:
+            try:
+                version = self.get_blueprint_version(bp_id)
+            except Exception:
+                version = None
+            entry = self.conditional.get(key)
+            if entry and version is not None and entry['version'] == version:
+                self.conditional.version_hits += 1
+                return [query.row(*r) for r in thaw(entry['body'])]
+        try:
+            items = self.inflight.run(key, endpoint,
+                                      lambda: self.fetch_json('POST', endpoint, {'query': query.text}))['items']
+        except requests.HTTPError as e:
+            if not self.graph_queries_unsupported(bp_id, e):
+                raise
+            logger.info(f"Graph queries rejected ({e.response.status_code}), using REST collections")
+            self.graph_queries = False
+            return None
+        rows = [query.row(*(i[query.name].get(f) for f in query.row._fields)) for i in items]
+        if self.conditional is not None:
+            # Row types are built at run time and cannot be pickled: kept as plain tuples
+            self.conditional.put(key, {}, [tuple(r) for r in rows], version)
+        return rows
+
+    # Whether a failed graph query means the controller does not take them at all. A 404 only does
+    # when the blueprint itself exists; otherwise it is about the blueprint and is raised.
+    def graph_queries_unsupported(self, bp_id, error):
+        status = error.response.status_code if error.response is not None else None
+        if status in (400, 405, 422):
+            return True
+        if status != 404:
+            return False
+        try:
+            self.make_api_request('GET', f"/api/blueprints/{bp_id}")
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return False
+            raise
+        return True
+
+    # Switches of a blueprint as rows of (system_id, hostname, label, role), or None without graph queries
+    def get_blueprint_systems(self, bp_id):
+        rows = self.graph_nodes(bp_id, 'system', ('system_id', 'hostname', 'label', 'role'), system_type='switch')
+        return None if rows is None else [r for r in rows if r.system_id]
+
+    def get_anomalies(self, blueprint_id, stream=False):
+        if stream:
+            return self.iter_anomalies(blueprint_id)
         try:
             endpoint = f"/api/blueprints/{blueprint_id}/anomalies"
             logger.debug(f"Polling tasks with endpoint: {endpoint}")
 
-            response = self.make_api_request('GET', endpoint)
+            response = self.conditional_request(endpoint)
             if not response:
                 logger.error("Received empty response from API")
                 return []
@@ -116,44 +887,162 @@ class ApstraClient:
         except Exception as e:
             logger.exception(e)
 
+    def get_probe_id(self, bp_id, probe_label):
+        index = self.probe_indexes[bp_id]
+        probe_id = index.id_for(probe_label)
+        if probe_id is None:
+            response = self.cached_request('probes', f"/api/blueprints/{bp_id}/probes")
+            index.update(response.get('items', []))
+            probe_id = index.id_for(probe_label)
+        return probe_id
+
+    # A probe id that answered 404, e.g. because the probe was recreated: the blueprint's probes are
+    # listed again on next use
+    def forget_probes(self, bp_id):
+        self.probe_indexes.pop(bp_id, None)
+        if self.cache:
+            self.cache.discard(f"/api/blueprints/{bp_id}/probes")
+
+    # Anomalies of a blueprint scoped by probe, stage, anomaly type and/or system.
+    # The probe scope uses the probe's own anomaly endpoint, type and system go out as query filters.
+    # Every filter (and the optional predicate) is re-checked on the client, so the result is the
+    # same whether or not the controller could narrow it down. If it rejects the scoped query the
+    # whole collection is fetched instead, and what it rejected is not sent again: query filters, or
+    # the probe endpoint. A probe id that is not found is looked up once more first.
+    def query_anomalies(self, bp_id, probe_label=None, stage_name=None, anomaly_type=None, system_id=None,
+                        predicate=None):
+        wanted = {'probe_label': probe_label, 'stage_name': stage_name, 'system_id': system_id,
+                  'anomaly_type': anomaly_type}
+        wanted = {k: v for k, v in wanted.items() if v is not None}
+        if self.shares_anomalies():
+            return self.filter_anomalies(self.get_shared_anomalies(bp_id), wanted, predicate)
+        params = {k: wanted[k] for k in ('anomaly_type', 'system_id') if k in wanted}
+        for attempt in range(2):
+            endpoint = f"/api/blueprints/{bp_id}/anomalies"
+            probe_id = self.get_probe_id(bp_id, probe_label) if probe_label and self.probe_anomalies else None
+            if probe_id:
+                endpoint = f"/api/blueprints/{bp_id}/probes/{probe_id}/anomalies"
+            if params and self.anomaly_query_params:
+                scoped = f"{endpoint}?{urllib.parse.urlencode(params)}"
+            else:
+                scoped = endpoint
+
+            try:
+                return self.filter_anomalies(self.iter_api_items(scoped), wanted, predicate)
+            except requests.HTTPError as e:
+                status = e.response.status_code if e.response is not None else None
+                if status not in (400, 404, 422):
+                    raise
+                if probe_id and status == 404:
+                    self.forget_probes(bp_id)
+                    if attempt == 0:
+                        logger.info(f"Probe {probe_label} of blueprint {bp_id} not found, looking it up again")
+                        continue
+                    self.probe_anomalies = False
+                elif scoped != endpoint:
+                    self.anomaly_query_params = False
+                elif probe_id:
+                    self.probe_anomalies = False
+                logger.info(f"Scoped anomaly query {scoped} rejected, filtering on the client")
+                return self.filter_anomalies(self.iter_anomalies(bp_id), wanted, predicate)
+
+    # With an 'anomalies' cache TTL every caller (e.g. every pack of a pack runtime) filters one shared
+    # listing per blueprint, fetched at most once per TTL, instead of sending its own anomaly requests
+    def shares_anomalies(self):
+        return bool(self.cache and self.cache.enabled('anomalies'))
+
+    def get_shared_anomalies(self, bp_id):
+        return self.cached_request('anomalies', f"/api/blueprints/{bp_id}/anomalies").get('items', [])
+
+    # Consumes the (streamed) anomalies and keeps only the matching ones
+    def filter_anomalies(self, anos, wanted, predicate=None):
+        return [a for a in anos if self.anomaly_matches(a, wanted) and (predicate is None or predicate(a))]
+
+    @staticmethod
+    def anomaly_matches(a, wanted):
+        identity = a.get('identity') or {}
+        for k, v in wanted.items():
+            value = identity.get(k) if k in ANOMALY_IDENTITY_FIELDS else a.get(k)
+            if value != v:
+                return False
+        return True
+
     def get_bp_ids(self):
         try:
             endpoint = f"/api/blueprints"
             logger.debug(f"Get Blueprints with endpoint: {endpoint}")
 
-            response = self.make_api_request('GET', endpoint)
+            response = self.cached_request('blueprints', endpoint)
             if not response:
                 logger.error("Received empty response from API")
                 return []
-            return response.get('items', [])
+            items = response.get('items', [])
+            self.bp_index.update(items)
+            return items
         except Exception as e:
             logger.exception(e)
 
+    # Blueprint summary (as listed by /api/blueprints) for a label. Only re-lists on an index miss.
     def get_bp_by_label(self, label):
-        bps = self.get_bp_ids()
-        for b in bps:
-            if b['label'] == label:
-                return b
-        return None
+        bp_id = self.get_bp_id_by_label(label)
+        return self.bp_index.get(bp_id) if bp_id else None
 
-    def get_bp(self, bp_id):
+    def get_bp_id_by_label(self, label):
+        bp_id = self.bp_index.id_for(label)
+        if bp_id is None:
+            self.get_bp_ids()
+            bp_id = self.bp_index.id_for(label)
+        return bp_id
+
+    def get_bp_label(self, bp_id):
+        bp = self.bp_index.get(bp_id)
+        if bp is None:
+            self.get_bp_ids()
+            bp = self.bp_index.get(bp_id)
+        return bp['label'] if bp else None
+
+    def get_bp(self, bp_id, use_cache=True):
         try:
             endpoint = f"/api/blueprints/{bp_id}"
             logger.debug(f"Get Blueprint with id: {bp_id}")
+            if use_cache:
+                if self.conditional is not None:
+                    return self.conditional_request(endpoint, bp_id, versioned=True)
+                return self.cached_request('blueprints', endpoint)
             return self.make_api_request('GET', endpoint)
         except Exception as e:
             logger.exception(e)
             raise
 
+    def get_property_sets(self):
+        items = self.cached_request('property_sets', "/api/property-sets")['items']
+        self.ps_index.update(items)
+        return items
+
+    # Single property set by id, None if it no longer exists
+    def get_property_set_by_id(self, ps_id):
+        try:
+            p = self.cached_request('property_sets', f"/api/property-sets/{ps_id}")
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                self.ps_index.remove(ps_id)
+                return None
+            raise
+        self.ps_index.put(p)
+        return p
+
+    # A known label is fetched with a single-object GET; the collection is only listed on an index miss
     def get_property_set(self, name):
         try:
-            endpoint = f"/api/property-sets"
-            ps = self.make_api_request('GET', endpoint)['items']
-            #breakpoint()
-            #print(ps)
-            for p in ps:
-                if p['label'] == name:
+            ps_id = self.ps_index.id_for(name)
+            if ps_id:
+                p = self.get_property_set_by_id(ps_id)
+                if p and p.get('label') == name:
                     return p
+            self.get_property_sets()
+            ps_id = self.ps_index.id_for(name)
+            if ps_id:
+                return self.ps_index.get(ps_id)
             raise Exception("Property Set Not Found")
         except Exception as e:
             logger.exception(e)
@@ -166,6 +1055,8 @@ class ApstraClient:
         except Exception as e:
             logger.exception(e)
             raise
+        finally:
+            self.invalidate_cache(ep)
         return self.get_property_set(p['label'])
 
     def update_property_set(self, ps_id, p):
@@ -175,6 +1066,8 @@ class ApstraClient:
         except Exception as e:
             logger.exception(e)
             raise
+        finally:
+            self.invalidate_cache("/api/property-sets")
 
     def make_bp_configlet(self, bp_id, c):
         ep = f"/api/blueprints/{bp_id}/configlets"
@@ -188,7 +1081,11 @@ class ApstraClient:
     def get_load_balancing_policy(self,bp_id, name):
         ep = f"/api/blueprints/{bp_id}/load-balancing-policies"
         try:
-            vs = self.make_api_request(method='GET', endpoint=ep).values()
+            # Find the policy id with a graph query and fetch that policy alone
+            rows = self.graph_nodes(bp_id, 'load_balancing_policy', ('id', 'label'), label=name)
+            if rows is not None:
+                return self.conditional_request(f"{ep}/{rows[0].id}", bp_id, versioned=True) if rows else None
+            vs = self.conditional_request(ep, bp_id, versioned=True).values()
             for v in vs:
                 if v['label'] == name:
                     return v
@@ -199,27 +1096,97 @@ class ApstraClient:
     def update_load_balancing_policy(self, bp_id, p_id, policy):
         ep = f"/api/blueprints/{bp_id}/load-balancing-policies/{p_id}"
         try:
-            self.make_api_request(method='PUT', endpoint=ep, data=policy)
+            response = self.make_api_request(method='PUT', endpoint=ep, data=policy)
+            self.note_staging_version(bp_id, response)
+            return response
         except Exception as e:
             logger.exception(e)
             raise
+        finally:
+            # A staged change bumps the blueprint version
+            self.invalidate_cache(f"/api/blueprints/{bp_id}")
 
-    def deploy_blueprint(self, bp_id, comment):
-        version = self.get_bp(bp_id)['version']
+    # Remember the staging version reported by a blueprint write so a following deploy need not re-read it
+    def note_staging_version(self, bp_id, response):
+        if self.conditional is not None:
+            self.conditional.forget_probe(bp_id)
+        version = response.get('version', response.get('staging_version')) if isinstance(response, dict) else None
+        if version is None:
+            self.staging_versions.pop(bp_id, None)
+        else:
+            self.staging_versions[bp_id] = version
+
+    # Version to deploy: the one from the last write if known, else the small diff-status document,
+    # else the blueprint itself
+    def get_staging_version(self, bp_id):
+        version = self.staging_versions.get(bp_id)
+        if version is not None:
+            return version
+        try:
+            return self.make_api_request('GET', f"/api/blueprints/{bp_id}/diff-status")['staging_version']
+        except Exception:
+            return self.get_bp(bp_id, use_cache=False)['version']
+
+    def deploy_blueprint(self, bp_id, comment, version=None):
+        noted = version is None and bp_id in self.staging_versions
+        if version is None:
+            version = self.get_staging_version(bp_id)
         ep = f"/api/blueprints/{bp_id}/deploy"
         try:
-            self.make_api_request(method='PUT', endpoint=ep, data={'version': version, 'description': comment})
+            try:
+                self.make_api_request(method='PUT', endpoint=ep, data={'version': version, 'description': comment})
+            except requests.HTTPError as e:
+                # Someone else wrote to the blueprint after us: retry once with a freshly read version
+                if not noted or e.response is None or e.response.status_code not in (409, 422):
+                    raise
+                self.staging_versions.pop(bp_id, None)
+                self.make_api_request(method='PUT', endpoint=ep,
+                                      data={'version': self.get_staging_version(bp_id), 'description': comment})
+        except Exception as e:
+            logger.exception(e)
+            raise
+        finally:
+            self.staging_versions.pop(bp_id, None)
+            if self.conditional is not None:
+                self.conditional.forget_probe(bp_id)
+            self.invalidate_cache(f"/api/blueprints/{bp_id}")
+            if self.cache:
+                self.cache.discard("/api/blueprints")
+
+    # Changes since the previous call for the same blueprint and query:
+    # {'added': [anomaly, ...], 'changed': [anomaly, ...], 'cleared': [anomaly id, ...]}
+    def get_anomaly_changes(self, bp_id, **query):
+        if query:
+            anos = self.query_anomalies(bp_id, **query)
+        elif self.shares_anomalies():
+            anos = self.get_shared_anomalies(bp_id)
+        else:
+            endpoint = f"/api/blueprints/{bp_id}/anomalies"
+            if self.anomaly_tracker.needs_listing(bp_id):
+                self.feed_validators.pop(endpoint, None)
+            anos = self.iter_api_items_if_modified(endpoint)
+            if anos is None:
+                return {'added': [], 'changed': [], 'cleared': []}
+        return self.track_anomalies((bp_id,) + tuple(sorted(query.items())) if query else bp_id, anos)
+
+    # Diff an anomaly listing fetched elsewhere (e.g. by the async client) against the last one
+    def track_anomalies(self, key, anomalies):
+        return self.anomaly_tracker.diff(key, anomalies)
+
+    # Ask Apstra to push to a streaming receiver. Reuses an existing config for the same receiver.
+    def create_streaming_config(self, hostname, port, streaming_type="alerts", protocol="protoBufOverTcp"):
+        ep = "/api/streaming-config"
+        try:
+            for c in self.make_api_request('GET', ep).get('items', []):
+                if c.get('hostname') == hostname and c.get('port') == port and c.get('streaming_type') == streaming_type:
+                    return c['id']
+            return self.make_api_request(method='POST', endpoint=ep,
+                                         data={'hostname': hostname, 'port': port,
+                                               'streaming_type': streaming_type, 'protocol': protocol}).get('id')
         except Exception as e:
             logger.exception(e)
             raise
 
-    def get_oos_anomalies(self, bp_id):
-        anos = self.get_anomalies(bp_id)
-        oos = []
-        for a in anos:
-            #pprint.pprint(a)
-            #print(a['identity']['stage_name'])
-            if a['identity'].get('stage_name') == "Is Out of Sequence Packets Detected?":
-                oos.append(a)
-        return oos
+    def get_oos_anomalies(self, bp_id, probe_label=None):
+        return self.query_anomalies(bp_id, probe_label=probe_label, stage_name=OOS_STAGE_NAME, anomaly_type='probe')
 
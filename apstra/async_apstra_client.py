@@ -0,0 +1,326 @@
+import asyncio
+import logging
+import time
+
+import aiohttp
+
+from apstra_client import ApstraClient, OOS_STAGE_NAME
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+# Streaming needs ijson 3 (use_float, async files). With ijson 2, which pysnow pins, bodies are
+# decoded in one piece as when it is missing.
+if ijson is not None and int(ijson.__version__.split('.')[0]) < 3:
+    ijson = None
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS")
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+# asyncio counterpart of ApstraClient. Same method surface, but every call is a coroutine so
+# requests against several blueprints can be in flight at once over one pooled session.
+class AsyncApstraClient:
+    def __init__(self, base_url, username, port, password, ssl_verify, pool_size=10, retries=3,
+                 backoff_factor=0.5, max_concurrency=8, auth_token=None, metrics=None, conditional=False):
+        self.auth_token = auth_token
+        self.conditional = conditional
+        self.etags = {}
+        self.metrics = metrics
+        self.base_url = base_url
+        self.username = username
+        self.password = password
+        self.port = port
+        self.ssl_verify = ssl_verify
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.max_concurrency = max_concurrency
+        self._session = None
+        self._login_lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    # The aiohttp session has to be created from inside a running loop, so it is made on first use
+    def get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, ssl=None if self.ssl_verify else False)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def login(self):
+        try:
+            response = await self.timed_request('POST', "/api/aaa/login", json={
+                "username": self.username,
+                "password": self.password
+            })
+            try:
+                response.raise_for_status()
+                self.auth_token = (await response.json(content_type=None)).get('token')
+            finally:
+                response.release()
+            if not self.auth_token:
+                logger.error("No token in authentication response")
+                return
+            logger.info("Successfully obtained authentication token")
+        except Exception as e:
+            logger.exception(f"Failed to get auth token: {str(e)}")
+
+    # Single-flight token refresh, see ApstraClient.refresh_token
+    async def refresh_token(self, stale_token):
+        async with self._login_lock:
+            if self.auth_token == stale_token:
+                if self.metrics and stale_token:
+                    self.metrics.record_relogin()
+                await self.login()
+            return self.auth_token
+
+    # One HTTP exchange; the caller releases the response. When a ClientMetrics is attached
+    # (usually the blocking client's) the exchange is recorded there, timed up to the response headers.
+    async def timed_request(self, method, endpoint, **kwargs):
+        url = f"{self.base_url.rstrip('/')}:{self.port}{endpoint}"
+        start = time.perf_counter()
+        try:
+            response = await self.get_session().request(method, url, **kwargs)
+        except Exception:
+            if self.metrics:
+                self.metrics.record(method, endpoint, 'error', time.perf_counter() - start)
+            raise
+        if self.metrics:
+            self.metrics.record(method, endpoint, response.status, time.perf_counter() - start,
+                                response.content_length or 0)
+        return response
+
+    async def send_request(self, method, endpoint, data=None):
+        attempts = self.retries + 1 if method in IDEMPOTENT_METHODS else 1
+        for attempt in range(attempts):
+            try:
+                token = self.auth_token or await self.refresh_token(None)
+                response = await self.timed_request(method, endpoint, json=data, headers={'authtoken': token})
+                try:
+                    if response.status == 401:
+                        response.release()
+                        token = await self.refresh_token(token)
+                        response = await self.timed_request(method, endpoint, json=data,
+                                                            headers={'authtoken': token})
+                    if response.status in RETRY_STATUSES and attempt < attempts - 1:
+                        await asyncio.sleep(self.backoff_factor * (2 ** attempt))
+                        continue
+                    return await self.read_response(response)
+                finally:
+                    response.release()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt == attempts - 1:
+                    raise
+                await asyncio.sleep(self.backoff_factor * (2 ** attempt))
+
+    @staticmethod
+    async def read_response(response):
+        response.raise_for_status()
+        text = await response.text()
+        if text.strip() == "":
+            return {}
+        return await response.json(content_type=None)
+
+    # GET whose body has not been read yet, for streaming
+    async def open_stream(self, endpoint, headers=None):
+        token = self.auth_token or await self.refresh_token(None)
+        response = await self.timed_request('GET', endpoint, headers={'authtoken': token} | (headers or {}))
+        if response.status == 401:
+            response.release()
+            token = await self.refresh_token(token)
+            response = await self.timed_request('GET', endpoint, headers={'authtoken': token} | (headers or {}))
+        response.raise_for_status()
+        return response
+
+    # Async generator over the elements of a collection response, decoded while the body streams in.
+    # Without ijson installed the body is decoded in one piece and then iterated.
+    async def iter_api_items(self, endpoint, path='items'):
+        try:
+            response = await self.open_stream(endpoint)
+        except Exception as e:
+            logger.exception(f"API request failed: {str(e)}")
+            raise
+        async for item in self.iter_response_items(response, path):
+            yield item
+
+    async def iter_response_items(self, response, path, on_complete=None):
+        try:
+            if ijson is None:
+                body = await self.read_response(response)
+                for item in body.get(path, []):
+                    yield item
+            else:
+                async for item in ijson.items(response.content, f"{path}.item", use_float=True):
+                    yield item
+            if on_complete:
+                on_complete()
+        finally:
+            response.release()
+
+    # Streamed collection, or None when the server answers 304 to the ETag of the last listing that
+    # was consumed completely, see ApstraClient.iter_api_items_if_modified
+    async def iter_api_items_if_modified(self, endpoint, path='items'):
+        if not self.conditional:
+            return self.iter_api_items(endpoint, path)
+        headers = {'If-None-Match': self.etags[endpoint]} if self.etags.get(endpoint) else {}
+        try:
+            response = await self.open_stream(endpoint, headers)
+        except Exception as e:
+            logger.exception(f"API request failed: {str(e)}")
+            raise
+        if response.status == 304:
+            response.release()
+            return None
+        etag = response.headers.get('ETag')
+        return self.iter_response_items(response, path, lambda: self.etags.__setitem__(endpoint, etag))
+
+    def iter_anomalies(self, blueprint_id):
+        return self.iter_api_items(f"/api/blueprints/{blueprint_id}/anomalies")
+
+    async def make_api_request(self, method, endpoint, data=None):
+        try:
+            return await self.send_request(method, endpoint, data)
+        except Exception as e:
+            logger.exception(f"API request failed: {str(e)}")
+            raise
+
+    # Run fn(item) for every item with at most `concurrency` calls in flight.
+    # Results come back in the order of items; a failed call yields its exception instead of a result.
+    async def fan_out(self, fn, items, concurrency=None):
+        semaphore = asyncio.Semaphore(concurrency or self.max_concurrency)
+
+        async def bounded(item):
+            async with semaphore:
+                return await fn(item)
+
+        return await asyncio.gather(*(bounded(i) for i in items), return_exceptions=True)
+
+    async def get_task_details(self, blueprint_id, task_id):
+        """Get detailed task info"""
+        try:
+            endpoint = f"/api/blueprints/{blueprint_id}/tasks/{task_id}"
+            logger.debug(f"Getting task details for task {task_id}")
+            task_detail = await self.make_api_request('GET', endpoint)
+            if not task_detail:
+                logger.error(f"No details returned for task {task_id}")
+                return None
+            return task_detail
+        except Exception as e:
+            logger.error(f"Failed to get task details for {task_id}: {str(e)}")
+            return None
+
+    async def get_tasks(self, blueprint_id):
+        try:
+            endpoint = f"/api/blueprints/{blueprint_id}/tasks"
+            response = await self.make_api_request('GET', endpoint)
+            if not response:
+                logger.error("Received empty response from API")
+                return []
+            return response.get('items', [])
+        except Exception as e:
+            logger.exception(e)
+
+    async def get_anomalies(self, blueprint_id):
+        try:
+            endpoint = f"/api/blueprints/{blueprint_id}/anomalies"
+            response = await self.make_api_request('GET', endpoint)
+            if not response:
+                logger.error("Received empty response from API")
+                return []
+            return response.get('items', [])
+        except Exception as e:
+            logger.exception(e)
+
+    async def get_bp_ids(self):
+        try:
+            response = await self.make_api_request('GET', "/api/blueprints")
+            if not response:
+                logger.error("Received empty response from API")
+                return []
+            return response.get('items', [])
+        except Exception as e:
+            logger.exception(e)
+
+    async def get_bp_by_label(self, label):
+        for b in await self.get_bp_ids():
+            if b['label'] == label:
+                return b
+        return None
+
+    async def get_bp(self, bp_id):
+        try:
+            return await self.make_api_request('GET', f"/api/blueprints/{bp_id}")
+        except Exception as e:
+            logger.exception(e)
+            raise
+
+    async def get_property_set(self, name):
+        try:
+            ps = (await self.make_api_request('GET', "/api/property-sets"))['items']
+            for p in ps:
+                if p['label'] == name:
+                    return p
+            raise Exception("Property Set Not Found")
+        except Exception as e:
+            logger.exception(e)
+            raise
+
+    async def make_property_set(self, p):
+        try:
+            await self.make_api_request(method='POST', endpoint="/api/property-sets", data=p)
+        except Exception as e:
+            logger.exception(e)
+            raise
+        return await self.get_property_set(p['label'])
+
+    async def update_property_set(self, ps_id, p):
+        try:
+            await self.make_api_request(method='PUT', endpoint=f"/api/property-sets/{ps_id}", data=p)
+        except Exception as e:
+            logger.exception(e)
+            raise
+
+    async def get_load_balancing_policy(self, bp_id, name):
+        ep = f"/api/blueprints/{bp_id}/load-balancing-policies"
+        try:
+            for v in (await self.make_api_request(method='GET', endpoint=ep)).values():
+                if v['label'] == name:
+                    return v
+        except Exception as e:
+            logger.exception(e)
+            raise
+
+    async def update_load_balancing_policy(self, bp_id, p_id, policy):
+        ep = f"/api/blueprints/{bp_id}/load-balancing-policies/{p_id}"
+        try:
+            await self.make_api_request(method='PUT', endpoint=ep, data=policy)
+        except Exception as e:
+            logger.exception(e)
+            raise
+
+    async def deploy_blueprint(self, bp_id, comment):
+        version = (await self.get_bp(bp_id))['version']
+        ep = f"/api/blueprints/{bp_id}/deploy"
+        try:
+            await self.make_api_request(method='PUT', endpoint=ep, data={'version': version, 'description': comment})
+        except Exception as e:
+            logger.exception(e)
+            raise
+
+    # Same selection as ApstraClient.get_oos_anomalies
+    async def get_oos_anomalies(self, bp_id):
+        wanted = {'stage_name': OOS_STAGE_NAME, 'anomaly_type': 'probe'}
+        return [a for a in await self.get_anomalies(bp_id) or [] if ApstraClient.anomaly_matches(a, wanted)]
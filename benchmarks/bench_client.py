@@ -0,0 +1,206 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for d in ("SnowTickets", "DLBTuning", "power_pack", "apstra"):
+    sys.path.insert(0, os.path.join(REPO, d))
+
+from apstra_client import ApstraClient
+from mock_apstra import MockApstraServer, config_arguments, config_from_args
+
+DLB_MANAGER = "DLB Manager"
+TICKET_MANAGER = "Ticket Manager"
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def http_requests(client):
+    return sum(e['count'] for e in client.metrics.snapshot()['endpoints'])
+
+
+# Call fn `iterations` times (spread over `threads` threads) and report calls/s, HTTP requests per
+# call, p50/p99 latency and the peak memory allocated while running
+def measure(name, fn, client, iterations, threads=1):
+    latencies = []
+
+    def timed(_):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+
+    requests_before = http_requests(client)
+    tracemalloc.start()
+    start = time.perf_counter()
+    if threads > 1:
+        with ThreadPoolExecutor(threads) as pool:
+            list(pool.map(timed, range(iterations)))
+    else:
+        for i in range(iterations):
+            timed(i)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        'name': name,
+        'calls': iterations,
+        'calls_per_s': iterations / elapsed if elapsed else 0.0,
+        'http_per_call': (http_requests(client) - requests_before) / iterations,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'peak_mib': peak / (1024 * 1024),
+    }
+
+
+def seed_pack_property_sets(server):
+    state = server.state
+    labels = [b['label'] for b in state.blueprints.values()]
+    state.add_property_set(DLB_MANAGER, {'blueprint': labels[0], 'lb_policy': "default", 'inactivity_timer_delta': 16,
+                                         'oos_probe': "DLB OOS Packets", 'pause': "false"})
+    state.add_property_set(TICKET_MANAGER, {'blueprints': ",".join(labels), 'pause': "false",
+                                            'ignore_devices': [], 'ignore_anomalies': [],
+                                            'include_only_anomalies': [], 'include_only_devices': [],
+                                            'include_only_severity': []})
+    state.add_property_set("tickets", {'tickets_info': []})
+    state.add_property_set("device_sys_ids", {'devices_info': {s['id']: f"ci-{s['id']}" for s in state.systems}})
+
+
+def client_benchmarks(server, args):
+    client = ApstraClient(base_url=server.base_url, port=server.port, username="admin", password="admin",
+                          ssl_verify=False, pool_size=max(10, args.threads))
+    if args.conditional:
+        client.configure_conditional()
+    bps = client.get_bp_ids()
+    bp_id, bp_label = bps[0]['id'], bps[0]['label']
+    ps_id = client.get_property_set("ps-0")['id']
+    cases = [
+        ("login", client.login),
+        ("get_bp_ids", client.get_bp_ids),
+        ("get_bp_by_label", lambda: client.get_bp_by_label(bp_label)),
+        ("get_bp", lambda: client.get_bp(bp_id)),
+        ("get_property_set", lambda: client.get_property_set("ps-0")),
+        ("update_property_set", lambda: client.update_property_set(ps_id, {'label': "ps-0", 'values': {'n': 1}})),
+        ("get_anomalies", lambda: client.get_anomalies(bp_id)),
+        ("iter_anomalies", lambda: sum(1 for _ in client.iter_anomalies(bp_id))),
+        ("get_oos_anomalies", lambda: client.get_oos_anomalies(bp_id, "DLB OOS Packets")),
+        ("get_anomaly_changes", lambda: client.get_anomaly_changes(bp_id)),
+        ("get_load_balancing_policy", lambda: client.get_load_balancing_policy(bp_id, "default")),
+        ("deploy_blueprint", lambda: client.deploy_blueprint(bp_id, "benchmark")),
+    ]
+    results = [measure(name, fn, client, args.iterations, args.threads) for name, fn in cases]
+
+    # 401 path: every call has to log in again first
+    def expired():
+        server.expire_tokens()
+        client.get_bp_ids()
+    results.append(measure("get_bp_ids after 401", expired, client, args.iterations, 1))
+    return results
+
+
+def write_setup(path, setup):
+    with open(path, "w") as f:
+        yaml.safe_dump(setup, f)
+
+
+# Create tickets in memory instead of ServiceNow, so a cycle measures the Apstra side only
+class BenchIncidents:
+    class Response:
+        def __init__(self, record):
+            self.record = record
+
+        def all(self):
+            return [self.record]
+
+    def __init__(self):
+        self.created = 0
+        self.updated = 0
+
+    def create(self, payload):
+        self.created += 1
+        return self.Response({'number': {'value': f"INC{self.created:07d}"},
+                              'sys_id': {'value': f"sys-{self.created}"}})
+
+    def update(self, query, payload):
+        self.updated += 1
+        return self.Response({'number': {'value': query.get('number')}})
+
+
+def pack_benchmarks(server, args):
+    os.environ.update({'APSTRA_URL': server.base_url, 'APSTRA_PORT': str(server.port),
+                       'APSTRA_USER': "admin", 'APSTRA_PASS': "admin", 'SNOW_PASS': "bench"})
+    results = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            quiet = contextlib.redirect_stdout(io.StringIO())
+            if "dlb" in args.packs:
+                write_setup("setup.yaml", {'wait_time_seconds': 1, 'management_property_set': DLB_MANAGER,
+                                           'cache_ttl_seconds': args.cache_ttl,
+                                           'conditional_fetch': args.conditional})
+                from dlb_tuner import DLBTunerPack
+                with quiet:
+                    pp = DLBTunerPack()
+                    results.append(measure("DLBTunerPack.worker", pp.worker, pp.aos_client, args.cycles))
+            if "snow" in args.packs:
+                write_setup("setup.yaml", {'wait_time_seconds': 1, 'management_property_set': TICKET_MANAGER,
+                                           'tickets_property_set': "tickets",
+                                           'devices_property_set': "device_sys_ids",
+                                           'snow': {'instance': "bench", 'user': "bench"},
+                                           'cache_ttl_seconds': args.cache_ttl,
+                                           'conditional_fetch': args.conditional})
+                from snow_tickets import SNOWPowerPack
+                with quiet:
+                    pp = SNOWPowerPack()
+                    pp.incident = BenchIncidents()
+                    results.append(measure("SNOWPowerPack.worker (first)", pp.worker, pp.aos_client, 1))
+                    results.append(measure("SNOWPowerPack.worker", pp.worker, pp.aos_client, args.cycles))
+        finally:
+            os.chdir(cwd)
+    return results
+
+
+def print_table(results):
+    print(f"{'benchmark':34} {'calls':>6} {'calls/s':>9} {'http/call':>9} {'p50 ms':>9} {'p99 ms':>9} {'peak MiB':>9}")
+    for r in results:
+        print(f"{r['name']:34} {r['calls']:>6} {r['calls_per_s']:>9.1f} {r['http_per_call']:>9.2f} "
+              f"{r['p50_ms']:>9.2f} {r['p99_ms']:>9.2f} {r['peak_mib']:>9.2f}")
+
+
+if __name__ == '__main__':
+    parser = config_arguments(argparse.ArgumentParser(description="ApstraClient and power pack benchmarks"))
+    parser.add_argument("--iterations", type=int, default=50, help="calls per client method")
+    parser.add_argument("--threads", type=int, default=1, help="concurrent callers per client method")
+    parser.add_argument("--cycles", type=int, default=10, help="worker cycles per pack")
+    parser.add_argument("--packs", default="dlb,snow", help="comma separated: dlb, snow, none")
+    parser.add_argument("--cache-ttl", type=float, default=None, help="cache_ttl_seconds for the packs")
+    parser.add_argument("--conditional", action="store_true", help="enable conditional fetching (ETag, version probe)")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+    args.packs = [p for p in args.packs.split(",") if p and p != "none"]
+
+    server = MockApstraServer(config_from_args(args)).start()
+    seed_pack_property_sets(server)
+    try:
+        results = client_benchmarks(server, args) + pack_benchmarks(server, args)
+    finally:
+        server.stop()
+    print_table(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({'results': results, 'server_requests': server.request_counts(), 'args': vars(args)}, f,
+                      indent=2)
@@ -0,0 +1,421 @@
+import argparse
+import ast
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+import uuid
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+OOS_STAGE_NAME = "Is Out of Sequence Packets Detected?"
+PROBES = ("ECN Anomalies", "PFC Anomalies", "Interface_Queue_Counter", "DLB OOS Packets")
+
+
+# Sizes and behaviour of the mock controller
+class MockConfig:
+    def __init__(self, blueprints=3, anomalies=500, systems=64, property_sets=50, lb_policies=4,
+                 blueprint_nodes=2000, latency_ms=0.0, jitter_ms=0.0, token_ttl=None, anomaly_churn=0.0,
+                 username="admin", password="admin", seed=1):
+        self.blueprints = blueprints
+        self.anomalies = anomalies
+        self.systems = systems
+        self.property_sets = property_sets
+        self.lb_policies = lb_policies
+        self.blueprint_nodes = blueprint_nodes
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.token_ttl = token_ttl
+        self.anomaly_churn = anomaly_churn
+        self.username = username
+        self.password = password
+        self.seed = seed
+
+
+# In-memory controller state: blueprints with anomalies, probes and load balancing policies,
+# managed systems and property sets
+class MockState:
+    def __init__(self, config):
+        self.config = config
+        self.rand = random.Random(config.seed)
+        self.lock = threading.Lock()
+        self.tokens = {}
+        self.requests = defaultdict(int)
+        self.systems = [self.make_system(i) for i in range(config.systems)]
+        self.blueprints = {}
+        for b in range(config.blueprints):
+            self.add_blueprint(f"bp-{b}")
+        self.property_sets = {}
+        for p in range(config.property_sets):
+            self.add_property_set(f"ps-{p}", {'filler': list(range(20))})
+
+    def make_system(self, i):
+        serial = f"SN{i:06d}"
+        return {
+            'id': serial,
+            'facts': {'serial_number': serial, 'mgmt_ipaddr': f"10.0.{i // 256}.{i % 256}",
+                      'mgmt_macaddr': "52:54:00:%02x:%02x:%02x" % (i >> 16 & 255, i >> 8 & 255, i & 255),
+                      'vendor': "Juniper", 'hw_model': "QFX5220-32CD"},
+            'status': {'hostname': f"leaf{i}", 'state': "OOS-READY"},
+        }
+
+    def add_blueprint(self, label):
+        bp_id = str(uuid.UUID(int=self.rand.getrandbits(128)))
+        probes = {str(uuid.UUID(int=self.rand.getrandbits(128))): label_ for label_ in PROBES}
+        policies = {}
+        for i in range(self.config.lb_policies):
+            p_id = f"lbp-{i}"
+            policies[p_id] = {'id': p_id, 'label': "default" if i == 0 else f"policy-{i}",
+                              'dlb_options': {'flowlet_options': {'inactivity_interval': 64}}}
+        self.blueprints[bp_id] = {
+            'id': bp_id, 'label': label, 'version': 1, 'deployed_version': 1, 'etags': {},
+            'probes': probes, 'policies': policies, 'lock_status': "unlocked",
+            'anomalies': [self.make_anomaly(bp_id, list(probes.items()), i) for i in range(self.config.anomalies)],
+        }
+        return bp_id
+
+    def make_anomaly(self, bp_id, probes, i):
+        system = self.systems[i % len(self.systems)] if self.systems else None
+        probe_id, probe_label = probes[i % len(probes)]
+        stage = OOS_STAGE_NAME if probe_label == "DLB OOS Packets" else "Range"
+        return {
+            'id': f"{bp_id[:8]}-ano-{i}",
+            'anomaly_type': "probe",
+            'severity': "critical",
+            'role': "leaf",
+            'identity': {'probe_id': probe_id, 'probe_label': probe_label, 'stage_name': stage,
+                         'system_id': system['id'] if system else None, 'interface': f"et-0/0/{i % 32}"},
+            'expected': {'value': 0},
+            'actual': {'value': self.rand.randint(1, 1000)},
+            'last_modified_at': time.time(),
+        }
+
+    def add_property_set(self, label, values):
+        ps_id = str(uuid.UUID(int=self.rand.getrandbits(128)))
+        self.property_sets[ps_id] = {'id': ps_id, 'label': label, 'values': values}
+        return ps_id
+
+    def property_set_by_label(self, label):
+        return next((p for p in self.property_sets.values() if p['label'] == label), None)
+
+    # Change the measured value of a fraction of a blueprint's anomalies
+    def churn(self, bp):
+        count = int(len(bp['anomalies']) * self.config.anomaly_churn)
+        for a in self.rand.sample(bp['anomalies'], count) if count else []:
+            a['actual']['value'] = self.rand.randint(1, 1000)
+            a['last_modified_at'] = time.time()
+
+    def graph_nodes(self, bp):
+        for s in self.systems:
+            yield {'id': f"node-{s['id']}", 'type': "system", 'system_id': s['id'], 'system_type': "switch",
+                   'hostname': s['status']['hostname'], 'label': s['status']['hostname'], 'role': "leaf"}
+        for p in bp['policies'].values():
+            yield {'id': p['id'], 'type': "load_balancing_policy", 'label': p['label']}
+
+    def blueprint_body(self, bp):
+        return {'id': bp['id'], 'label': bp['label'], 'version': bp['version'],
+                'nodes': {f"node-{i}": {'id': f"node-{i}", 'type': "system", 'label': f"leaf{i}"}
+                          for i in range(self.config.blueprint_nodes)}}
+
+
+class MockApstraHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; with Nagle on, the body waits for the delayed ACK
+    disable_nagle_algorithm = True
+    # Replies of a route handler, collected while it holds the state lock
+    held = None
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length)) if length else None
+
+    # Inside a route handler the reply is only recorded; dispatch writes it once the state lock is released
+    def reply(self, status, body=None, headers=None):
+        if self.held is not None:
+            self.held.append((status, body, headers))
+            return
+        self.write_reply(status, body, headers)
+
+    # GETs carry an ETag of their payload and answer 304 when it matches If-None-Match
+    def write_reply(self, status, body=None, headers=None):
+        payload = b"" if body is None else json.dumps(body).encode()
+        if self.command == 'GET' and status == 200:
+            etag = '"' + hashlib.blake2b(payload, digest_size=16).hexdigest() + '"'
+            headers = dict(headers or {}, ETag=etag)
+            if self.headers.get('If-None-Match') == etag:
+                status, payload = 304, b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def authorized(self):
+        token = self.headers.get('authtoken')
+        issued = self.state.tokens.get(token)
+        if issued is None:
+            return False
+        ttl = self.state.config.token_ttl
+        return ttl is None or time.monotonic() - issued < ttl
+
+    def dispatch(self, method):
+        cfg = self.state.config
+        if cfg.latency_ms or cfg.jitter_ms:
+            time.sleep((cfg.latency_ms + random.uniform(0, cfg.jitter_ms)) / 1000.0)
+        parsed = urllib.parse.urlparse(self.path)
+        path = parsed.path.rstrip('/') or '/'
+        query = dict(urllib.parse.parse_qsl(parsed.query))
+        body = self.read_body()
+        with self.state.lock:
+            self.state.requests[(method, re.sub(r"/(blueprints|property-sets|probes|load-balancing-policies|systems)/[^/]+",
+                                                r"/\1/{id}", path))] += 1
+        if path == "/api/aaa/login" and method == 'POST':
+            if not body or body.get('username') != cfg.username or body.get('password') != cfg.password:
+                return self.reply(401, {'errors': "bad credentials"})
+            token = uuid.uuid4().hex
+            self.state.tokens[token] = time.monotonic()
+            return self.reply(201, {'token': token, 'id': "admin"})
+        if not self.authorized():
+            return self.reply(401, {'errors': "token expired"})
+        for pattern, handler in ROUTES:
+            m = re.fullmatch(pattern, path)
+            if m:
+                # The lock covers computing the body only; encoding and writing it run concurrently
+                self.held = []
+                try:
+                    with self.state.lock:
+                        handler(self, method, query, body, *m.groups())
+                finally:
+                    replies, self.held = self.held, None
+                return self.write_reply(*replies[0])
+        return self.reply(404, {'errors': f"no route {path}"})
+
+    def blueprint(self, bp_id):
+        bp = self.state.blueprints.get(bp_id)
+        if bp is None:
+            self.reply(404, {'errors': "blueprint not found"})
+        return bp
+
+    def r_blueprints(self, method, query, body):
+        if method != 'GET':
+            return self.reply(405)
+        return self.reply(200, {'items': [{'id': b['id'], 'label': b['label'], 'version': b['version']}
+                                          for b in self.state.blueprints.values()]})
+
+    def r_blueprint(self, method, query, body, bp_id):
+        bp = self.blueprint(bp_id)
+        if bp:
+            return self.reply(200, self.state.blueprint_body(bp))
+
+    def r_anomalies(self, method, query, body, bp_id, probe_id=None):
+        bp = self.blueprint(bp_id)
+        if not bp:
+            return
+        if probe_id is not None and probe_id not in bp['probes']:
+            return self.reply(404, {'errors': "probe not found"})
+        self.state.churn(bp)
+        items = [a for a in bp['anomalies']
+                 if (probe_id is None or a['identity']['probe_id'] == probe_id)
+                 and all(a.get(k, a['identity'].get(k)) == v for k, v in query.items()
+                         if k in ('anomaly_type', 'system_id'))]
+        return self.reply(200, {'items': items, 'count': len(items)})
+
+    def r_probe_anomalies(self, method, query, body, bp_id, probe_id):
+        return self.r_anomalies(method, query, body, bp_id, probe_id)
+
+    def r_probes(self, method, query, body, bp_id):
+        bp = self.blueprint(bp_id)
+        if bp:
+            return self.reply(200, {'items': [{'id': i, 'label': l} for i, l in bp['probes'].items()]})
+
+    def r_diff_status(self, method, query, body, bp_id):
+        bp = self.blueprint(bp_id)
+        if bp:
+            return self.reply(200, {'staging_version': bp['version'], 'deployed_version': bp['deployed_version'],
+                                    'status': "undeployed" if bp['version'] != bp['deployed_version'] else "deployed"})
+
+    def r_lock_status(self, method, query, body, bp_id):
+        bp = self.blueprint(bp_id)
+        if bp:
+            return self.reply(200, {'lock_status': bp['lock_status']})
+
+    def r_deploy(self, method, query, body, bp_id):
+        bp = self.blueprint(bp_id)
+        if not bp:
+            return
+        if method != 'PUT':
+            return self.reply(200, {'version': bp['deployed_version']})
+        if not body or body.get('version') != bp['version']:
+            return self.reply(409, {'errors': f"version mismatch, staging version is {bp['version']}"})
+        bp['deployed_version'] = bp['version']
+        return self.reply(202, {})
+
+    def r_policies(self, method, query, body, bp_id):
+        bp = self.blueprint(bp_id)
+        if bp:
+            return self.reply(200, bp['policies'])
+
+    def r_policy(self, method, query, body, bp_id, p_id):
+        bp = self.blueprint(bp_id)
+        if not bp:
+            return
+        if p_id not in bp['policies']:
+            return self.reply(404, {'errors': "policy not found"})
+        if method == 'PUT':
+            bp['policies'][p_id] = dict(body, id=p_id)
+            bp['version'] += 1
+            return self.reply(200, {})
+        return self.reply(200, bp['policies'][p_id])
+
+    def r_systems(self, method, query, body):
+        return self.reply(200, {'items': self.state.systems})
+
+    # Graph queries of the form match(node('type', name='n', attr=value, ...)) over system and
+    # load_balancing_policy nodes
+    def r_qe(self, method, query, body, bp_id):
+        bp = self.blueprint(bp_id)
+        if not bp:
+            return
+        try:
+            node = ast.parse(body['query'], mode='eval').body.args[0]
+            node_type = ast.literal_eval(node.args[0])
+            where = {k.arg: ast.literal_eval(k.value) for k in node.keywords}
+        except (KeyError, SyntaxError, ValueError, AttributeError, IndexError, TypeError):
+            return self.reply(422, {'errors': "unsupported query"})
+        name = where.pop('name', node_type)
+        items = [{name: n} for n in self.state.graph_nodes(bp)
+                 if n['type'] == node_type and all(n.get(k) == v for k, v in where.items())]
+        return self.reply(200, {'items': items, 'count': len(items)})
+
+    def r_property_sets(self, method, query, body):
+        if method == 'POST':
+            if self.state.property_set_by_label(body.get('label')):
+                return self.reply(409, {'errors': "label already exists"})
+            return self.reply(201, {'id': self.state.add_property_set(body['label'], body.get('values', {}))})
+        return self.reply(200, {'items': list(self.state.property_sets.values())})
+
+    def r_property_set(self, method, query, body, ps_id):
+        ps = self.state.property_sets.get(ps_id)
+        if ps is None:
+            return self.reply(404, {'errors': "property set not found"})
+        if method == 'PUT':
+            ps.update(label=body.get('label', ps['label']), values=body.get('values', {}))
+            return self.reply(200, {})
+        if method == 'DELETE':
+            del self.state.property_sets[ps_id]
+            return self.reply(204)
+        return self.reply(200, ps)
+
+    def r_streaming_configs(self, method, query, body):
+        if method == 'POST':
+            return self.reply(201, {'id': uuid.uuid4().hex})
+        return self.reply(200, {'items': []})
+
+
+BP = r"/api/blueprints/([^/]+)"
+ROUTES = [
+    (r"/api/blueprints", MockApstraHandler.r_blueprints),
+    (BP, MockApstraHandler.r_blueprint),
+    (BP + r"/anomalies", MockApstraHandler.r_anomalies),
+    (BP + r"/probes", MockApstraHandler.r_probes),
+    (BP + r"/probes/([^/]+)/anomalies", MockApstraHandler.r_probe_anomalies),
+    (BP + r"/diff-status", MockApstraHandler.r_diff_status),
+    (BP + r"/lock-status", MockApstraHandler.r_lock_status),
+    (BP + r"/deploy", MockApstraHandler.r_deploy),
+    (BP + r"/load-balancing-policies", MockApstraHandler.r_policies),
+    (BP + r"/load-balancing-policies/([^/]+)", MockApstraHandler.r_policy),
+    (BP + r"/qe", MockApstraHandler.r_qe),
+    (r"/api/systems", MockApstraHandler.r_systems),
+    (r"/api/property-sets", MockApstraHandler.r_property_sets),
+    (r"/api/property-sets/([^/]+)", MockApstraHandler.r_property_set),
+    (r"/api/streaming-config", MockApstraHandler.r_streaming_configs),
+]
+
+
+class MockApstraServer(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, config=None, host="127.0.0.1", port=0):
+        super().__init__((host, port), MockApstraHandler)
+        self.state = MockState(config or MockConfig())
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.server_address[0]}"
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    # Expire every issued token, so the next request of each client gets a 401
+    def expire_tokens(self):
+        self.state.tokens.clear()
+
+    def request_counts(self):
+        with self.state.lock:
+            return {f"{m} {p}": c for (m, p), c in self.state.requests.items()}
+
+
+def config_arguments(parser):
+    parser.add_argument("--blueprints", type=int, default=3)
+    parser.add_argument("--anomalies", type=int, default=500, help="anomalies per blueprint")
+    parser.add_argument("--systems", type=int, default=64)
+    parser.add_argument("--property-sets", type=int, default=50)
+    parser.add_argument("--blueprint-nodes", type=int, default=2000, help="nodes in a blueprint document")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="added to every response")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="random extra latency up to this much")
+    parser.add_argument("--token-ttl", type=float, default=None, help="seconds until a token gets 401s")
+    parser.add_argument("--anomaly-churn", type=float, default=0.0,
+                        help="fraction of anomalies whose value changes on every anomaly GET")
+    return parser
+
+
+def config_from_args(args):
+    return MockConfig(blueprints=args.blueprints, anomalies=args.anomalies, systems=args.systems,
+                      property_sets=args.property_sets, blueprint_nodes=args.blueprint_nodes,
+                      latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, token_ttl=args.token_ttl,
+                      anomaly_churn=args.anomaly_churn)
+
+
+if __name__ == '__main__':
+    parser = config_arguments(argparse.ArgumentParser(description="Mock Apstra controller"))
+    parser.add_argument("--port", type=int, default=8443)
+    args = parser.parse_args()
+    server = MockApstraServer(config_from_args(args), host="0.0.0.0", port=args.port)
+    print(f"Mock Apstra listening on http://0.0.0.0:{args.port} (user admin / admin)")
+    server.serve_forever()
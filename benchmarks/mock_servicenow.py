@@ -0,0 +1,231 @@
+import argparse
+import base64
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+import uuid
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+NUMBER_PREFIXES = {'incident': "INC"}
+STATUS_TEXT = {200: "OK", 201: "Created", 204: "No Content", 400: "Bad Request", 404: "Not Found",
+               405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+# Behaviour of the stand-in ServiceNow instance
+class MockSnowConfig:
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, fail_rate=0.0, username="admin", password="admin", seed=1):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.fail_rate = fail_rate
+        self.username = username
+        self.password = password
+        self.seed = seed
+
+
+# In-memory tables (incident, cmdb_ci, ...) of records keyed by sys_id
+class MockSnowState:
+    def __init__(self, config):
+        self.config = config
+        self.rand = random.Random(config.seed)
+        self.lock = threading.Lock()
+        self.requests = defaultdict(int)
+        self.tables = defaultdict(dict)
+        self.numbers = defaultdict(int)
+
+    def insert(self, table, values):
+        record = dict(values, sys_id=uuid.uuid4().hex)
+        if table in NUMBER_PREFIXES:
+            self.numbers[table] += 1
+            record['number'] = f"{NUMBER_PREFIXES[table]}{self.numbers[table]:07d}"
+        self.tables[table][record['sys_id']] = record
+        return record
+
+    # sysparm_query of the form field=value^field=value
+    def select(self, table, query, limit=None):
+        where = dict(q.split("=", 1) for q in query.split("^") if "=" in q) if query else {}
+        rows = [r for r in self.tables[table].values() if all(str(r.get(k)) == v for k, v in where.items())]
+        return rows[:limit] if limit else rows
+
+    # Table API request, also used for the requests of a batch. Returns (status, body).
+    def table_request(self, method, path, query, body):
+        m = re.fullmatch(r"/api/now/(?:v\d+/)?table/([^/]+)(?:/([^/]+))?", path)
+        if m is None:
+            return 404, {'error': {'message': f"no route {path}"}}
+        table, sys_id = m.groups()
+        if self.config.fail_rate and self.rand.random() < self.config.fail_rate:
+            return 500, {'error': {'message': "injected failure"}}
+        shape = lambda r: display(r, query.get('sysparm_display_value'))
+        if sys_id is None:
+            if method == 'POST':
+                return 201, {'result': shape(self.insert(table, body or {}))}
+            if method == 'GET':
+                limit = int(query.get('sysparm_limit') or 0) or None
+                return 200, {'result': [shape(r) for r in self.select(table, query.get('sysparm_query'), limit)]}
+            return 405, {'error': {'message': "method not allowed"}}
+        record = self.tables[table].get(sys_id)
+        if record is None:
+            return 404, {'error': {'message': "record not found"}}
+        if method in ('PUT', 'PATCH'):
+            record.update(body or {})
+        elif method == 'DELETE':
+            del self.tables[table][sys_id]
+            return 204, None
+        return 200, {'result': shape(record)}
+
+
+# sysparm_display_value=all gives {'value': ..., 'display_value': ...} per field
+def display(record, display_value):
+    if str(display_value).lower() != "all":
+        return dict(record)
+    return {k: {'value': v, 'display_value': v} for k, v in record.items()}
+
+
+def split_url(url):
+    parsed = urllib.parse.urlparse(url)
+    return parsed.path.rstrip('/') or '/', dict(urllib.parse.parse_qsl(parsed.query))
+
+
+class MockSnowHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; with Nagle on, the body waits for the delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def do_PATCH(self):
+        self.dispatch('PATCH')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length)) if length else None
+
+    def reply(self, status, body=None):
+        payload = b"" if body is None else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def authorized(self):
+        auth = self.headers.get('Authorization') or ""
+        if not auth.startswith("Basic "):
+            return False
+        user, _, password = base64.b64decode(auth[6:]).decode().partition(":")
+        return user == self.state.config.username and password == self.state.config.password
+
+    def dispatch(self, method):
+        cfg = self.state.config
+        if cfg.latency_ms or cfg.jitter_ms:
+            time.sleep((cfg.latency_ms + random.uniform(0, cfg.jitter_ms)) / 1000.0)
+        path, query = split_url(self.path)
+        body = self.read_body()
+        if not self.authorized():
+            return self.reply(401, {'error': {'message': "User Not Authenticated"}})
+        # The lock covers the state only; replies are written without it
+        with self.state.lock:
+            self.state.requests[(method, re.sub(r"/table/([^/]+)/[^/]+", r"/table/\1/{sys_id}", path))] += 1
+        if path == "/api/now/v1/batch" and method == 'POST':
+            return self.reply(200, self.batch(body or {}))
+        with self.state.lock:
+            status, result = self.state.table_request(method, path, query, body)
+        return self.reply(status, result)
+
+    # Runs the base64 encoded requests of a batch in order and answers each with its status and
+    # base64 encoded body
+    def batch(self, body):
+        serviced = []
+        for r in body.get('rest_requests', []):
+            start = time.perf_counter()
+            path, query = split_url(r['url'])
+            request_body = json.loads(base64.b64decode(r['body'])) if r.get('body') else None
+            with self.state.lock:
+                status, result = self.state.table_request(r['method'], path, query, request_body)
+                self.state.requests[("BATCHED " + r['method'], re.sub(r"/table/([^/]+)/[^/]+",
+                                                                       r"/table/\1/{sys_id}", path))] += 1
+            serviced.append({
+                'id': r['id'], 'status_code': status, 'status_text': STATUS_TEXT.get(status, ""),
+                'headers': [{'name': "Content-Type", 'value': "application/json"}],
+                'body': base64.b64encode(json.dumps(result).encode()).decode() if result is not None else "",
+                'execution_time': round((time.perf_counter() - start) * 1000),
+            })
+        return {'batch_request_id': body.get('batch_request_id'), 'serviced_requests': serviced,
+                'unserviced_requests': []}
+
+
+class MockSnowServer(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, config=None, host="127.0.0.1", port=0):
+        super().__init__((host, port), MockSnowHandler)
+        self.state = MockSnowState(config or MockSnowConfig())
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def request_counts(self):
+        with self.state.lock:
+            return {f"{m} {p}": c for (m, p), c in self.state.requests.items()}
+
+    # Records of a table, e.g. the incidents the pack created
+    def records(self, table):
+        with self.state.lock:
+            return list(self.state.tables[table].values())
+
+
+def config_arguments(parser):
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="added to every response")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="random extra latency up to this much")
+    parser.add_argument("--fail-rate", type=float, default=0.0,
+                        help="fraction of table requests (batched or not) answered with a 500")
+    return parser
+
+
+def config_from_args(args):
+    return MockSnowConfig(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, fail_rate=args.fail_rate)
+
+
+if __name__ == '__main__':
+    parser = config_arguments(argparse.ArgumentParser(description="Stand-in ServiceNow instance"))
+    parser.add_argument("--port", type=int, default=8889)
+    args = parser.parse_args()
+    server = MockSnowServer(config_from_args(args), host="0.0.0.0", port=args.port)
+    print(f"Mock ServiceNow listening on http://0.0.0.0:{args.port} (user admin / admin)")
+    server.serve_forever()
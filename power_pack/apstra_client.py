@@ -0,0 +1 @@
+../apstra/apstra_client.py
\ No newline at end of file
@@ -0,0 +1,140 @@
+import heapq
+import importlib
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+from apstra_client import DEFAULT_CACHE_TTLS
+from power_pack import make_apstra_client, serve_metrics, startup_profile
+
+logger = logging.getLogger(__name__)
+
+
+# Hosts several power packs in one process. The packs share one logged in Apstra client: one token,
+# one connection pool, one property set cache and one anomaly listing per blueprint per tick.
+# Their worker and pause check cycles are run by one scheduler thread on a small thread pool
+# instead of two threads per pack.
+class PackRuntime:
+    def __init__(self, config_file="runtime.yaml"):
+        with open(config_file, "r") as f:
+            self.config = yaml.safe_load(f)
+        self.exit = threading.Event()
+        self.aos_client = make_apstra_client(defer_login=True)
+        ttls = {'anomalies': self.config.get('anomaly_ttl_seconds', 5)}
+        if self.config.get('cache_ttl_seconds'):
+            ttls = {r: self.config['cache_ttl_seconds'] for r in DEFAULT_CACHE_TTLS} | ttls
+        self.aos_client.configure_cache(ttls)
+        if self.config.get('conditional_fetch'):
+            self.aos_client.configure_conditional(self.config.get('version_probe_ttl_seconds', 2))
+        self.executor = ThreadPoolExecutor(self.config.get('worker_threads', 4), thread_name_prefix="pack")
+        self._metrics_server = None
+        # (deadline, sequence, pack, loop) of the next cycle of every loop that is not running
+        self._queue = []
+        self._sequence = 0
+        self._ready = threading.Condition()
+        # Packs are constructed side by side: their first requests share one login and their
+        # inventory loads overlap
+        for entry in self.config['packs']:
+            if entry.get('path'):
+                sys.path.insert(0, os.path.abspath(entry['path']))
+        self.packs = list(self.executor.map(self.load_pack, self.config['packs']))
+
+    # packs entry: module, class, setup_file and optionally path, the directory holding the module
+    def load_pack(self, entry):
+        with startup_profile.phase(f"import {entry['module']}"):
+            cls = getattr(importlib.import_module(entry['module']), entry['class'])
+        print(f"loading {entry['class']} with {entry.get('setup_file', 'setup.yaml')}")
+        return cls(setup_file=entry.get('setup_file', "setup.yaml"), aos_client=self.aos_client)
+
+    def schedule(self, pack, loop):
+        deadline = pack.schedulers[loop].advance(time.monotonic())
+        with self._ready:
+            self._sequence += 1
+            heapq.heappush(self._queue, (deadline, self._sequence, pack, loop))
+            self._ready.notify()
+
+    # A loop is only queued again once its cycle finished, so a slow cycle delays (and the scheduler
+    # records an overrun for) that loop alone and cycles of one loop never overlap
+    def run_cycle(self, pack, loop):
+        # Stopped on its own, e.g. over its control socket
+        if pack.exit.is_set():
+            return
+        try:
+            if loop == 'pause_check':
+                pack.pause_check_cycle()
+            elif not pack.is_paused():
+                pack.worker_cycle()
+        except Exception as e:
+            logger.exception(f"{type(pack).__name__} {loop} cycle failed: {e}")
+        finally:
+            if not self.exit.is_set():
+                self.schedule(pack, loop)
+
+    def run(self):
+        if self.config.get('metrics_port'):
+            self._metrics_server = serve_metrics(self, self.config['metrics_port'],
+                                                 self.config.get('metrics_host', "127.0.0.1"))
+        for pack in self.packs:
+            # Control sockets only: the runtime takes the signals for all packs
+            pack.start_control(signals=False)
+            if pack.setup.get('metrics_port'):
+                pack.start_metrics_server(pack.setup['metrics_port'], pack.setup.get('metrics_host', "127.0.0.1"))
+            if pack.streaming_enabled():
+                pack.start_receiver()
+                threading.Thread(target=pack.event_loop, daemon=True).start()
+            else:
+                self.schedule(pack, 'worker')
+            self.schedule(pack, 'pause_check')
+        with self._ready:
+            while not self.exit.is_set():
+                delay = self._queue[0][0] - time.monotonic() if self._queue else None
+                if delay is None or delay > 0:
+                    self._ready.wait(delay)
+                    continue
+                _, _, pack, loop = heapq.heappop(self._queue)
+                self.executor.submit(self.run_cycle, pack, loop)
+        print("Exiting Pack Runtime.")
+
+    def request_stop(self):
+        self.exit.set()
+        with self._ready:
+            self._ready.notify()
+
+    # SIGTERM / SIGINT: run() returns and the main thread stops the packs
+    def break_handler(self, signal_received, frame):
+        threading.Thread(target=self.request_stop, daemon=True).start()
+
+    # Cycles already running finish before their packs are stopped
+    def stop(self):
+        self.request_stop()
+        self.executor.shutdown(wait=True)
+        for pack in self.packs:
+            pack.stop()
+        if self._metrics_server:
+            self._metrics_server.shutdown()
+            self._metrics_server.server_close()
+            self._metrics_server = None
+        self.aos_client.close()
+
+    # The shared client's metrics, once for all packs, in the shape of a pack snapshot. The packs' own
+    # snapshots, which leave the client out, are added under 'packs'.
+    def metrics_snapshot(self):
+        return {'pack': type(self).__name__, 'client': self.aos_client.metrics_snapshot(), 'cycles': {},
+                'schedule': {}, 'startup': startup_profile.snapshot(),
+                'packs': {type(p).__name__: p.metrics_snapshot() for p in self.packs}}
+
+
+if __name__ == '__main__':
+    # python3 pack_runtime.py [runtime.yaml]
+    runtime = PackRuntime(sys.argv[1] if len(sys.argv) > 1 else "runtime.yaml")
+    signal.signal(signal.SIGTERM, runtime.break_handler)
+    signal.signal(signal.SIGINT, runtime.break_handler)
+    try:
+        runtime.run()
+    finally:
+        runtime.stop()
@@ -1,6 +1,16 @@
+import asyncio
+import contextlib
+import json
+import logging
 import os
+import queue
+import signal
+import socket
+import socketserver
+import sys
 import threading
 import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 # import pprint
 import requests
@@ -9,51 +19,558 @@ import yaml
 from apstra_client import ApstraClient
 
 
+# Calls and duration of the cycles of one loop (worker or pause check)
+class CycleStats:
+    def __init__(self):
+        self.cycles = 0
+        self.seconds = 0.0
+        self.calls = 0
+        self.last_seconds = 0.0
+        self.last_calls = 0
+        self.max_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds, calls):
+        with self._lock:
+            self.cycles += 1
+            self.seconds += seconds
+            self.calls += calls
+            self.last_seconds = seconds
+            self.last_calls = calls
+            self.max_seconds = max(self.max_seconds, seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {k: v for k, v in vars(self).items() if not k.startswith('_')}
+
+
+# Runs a loop on a fixed cadence against monotonic deadlines, so the period does not grow with the
+# time the cycle itself takes. A cycle that ends past the next deadline is an overrun: the next cycle
+# starts right away and any further ticks it ran over are skipped rather than run back to back.
+class DeadlineScheduler:
+    def __init__(self, interval, exit_event):
+        self.interval = interval
+        self.exit = exit_event
+        self.deadline = None
+        self.overruns = 0
+        self.skipped_ticks = 0
+        self.max_lateness = 0.0
+        self._lock = threading.Lock()
+
+    # Take now as the current tick, e.g. when the loop resumes after a pause
+    def restart(self):
+        self.deadline = time.monotonic()
+
+    # Move to the next deadline after a cycle that ended at `now` and return it
+    def advance(self, now):
+        if self.deadline is None:
+            self.deadline = now
+        else:
+            self.deadline += self.interval
+            late = now - self.deadline
+            if late > 0:
+                missed = int(late // self.interval)
+                with self._lock:
+                    self.overruns += 1
+                    self.skipped_ticks += missed
+                    self.max_lateness = max(self.max_lateness, late)
+                self.deadline += missed * self.interval
+        return self.deadline
+
+    # Sleep until the next deadline. False once exit is set.
+    def wait_next(self):
+        now = time.monotonic()
+        delay = self.advance(now) - now
+        if delay > 0:
+            self.exit.wait(delay)
+        return not self.exit.is_set()
+
+    def snapshot(self):
+        with self._lock:
+            return {'interval': self.interval, 'overruns': self.overruns, 'skipped_ticks': self.skipped_ticks,
+                    'max_lateness': self.max_lateness}
+
+
+# Worker interval that follows activity: back to `floor` after a cycle that saw changes, multiplied
+# by `backoff` after each quiet cycle, up to `ceiling`
+class AdaptiveInterval:
+    def __init__(self, floor, ceiling, backoff=2.0):
+        self.floor = floor
+        self.ceiling = max(floor, ceiling)
+        self.backoff = backoff
+        self.current = floor
+
+    def update(self, active):
+        self.current = self.floor if active else min(self.ceiling, self.current * self.backoff)
+        return self.current
+
+
+# Where the time goes between process start and the end of the first worker cycle: setup, login,
+# inventory loads... Phases run on different threads can overlap. The report is printed after the first
+# cycle when the pack is started with --profile-startup (or PACK_PROFILE_STARTUP is set).
+class StartupProfile:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.start = time.perf_counter()
+        self.before_import = self.process_age()
+        self.first_cycle = None
+        self.phases = []
+        self._lock = threading.Lock()
+
+    # Seconds the process ran before this module was imported (interpreter start, pack imports).
+    # None where /proc is not available.
+    @staticmethod
+    def process_age():
+        try:
+            with open("/proc/self/stat") as f:
+                started = int(f.read().rsplit(")", 1)[1].split()[19]) / os.sysconf('SC_CLK_TCK')
+            with open("/proc/uptime") as f:
+                return float(f.read().split()[0]) - started
+        except (OSError, ValueError, IndexError):
+            return None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases.append((name, start - self.start, time.perf_counter() - start,
+                                    threading.current_thread().name))
+
+    # fn(*args) timed as a phase, e.g. when submitted to a thread pool
+    def run(self, name, fn, *args):
+        with self.phase(name):
+            return fn(*args)
+
+    # Called after every worker cycle. True the first time only.
+    def cycle_done(self):
+        with self._lock:
+            if self.first_cycle is not None:
+                return False
+            self.first_cycle = time.perf_counter() - self.start
+            return True
+
+    def report(self):
+        lines = []
+        if self.before_import is not None:
+            lines.append(f"startup: {self.before_import:.2f}s before the power pack modules were imported")
+        lines.append(f"startup: first cycle done {self.first_cycle:.2f}s after import")
+        with self._lock:
+            for name, offset, seconds, thread in sorted(self.phases, key=lambda p: p[1]):
+                lines.append(f"  {name:<32} at {offset:7.2f}s took {seconds:7.2f}s  [{thread}]")
+        return "\n".join(lines)
+
+    def snapshot(self):
+        with self._lock:
+            return {'before_import': self.before_import, 'first_cycle': self.first_cycle,
+                    'phases': [{'name': n, 'offset': o, 'seconds': s, 'thread': t} for n, o, s, t in self.phases]}
+
+
+startup_profile = StartupProfile('--profile-startup' in sys.argv or bool(os.environ.get('PACK_PROFILE_STARTUP')))
+
+
+def prometheus_labels(**labels):
+    return "{" + ",".join(f'{k}="{str(v).replace(chr(34), chr(39))}"' for k, v in labels.items()) + "}"
+
+
+# Request, cache, coalescing and conditional fetch metrics of an ApstraClient.metrics_snapshot()
+def client_metric_lines(pack, client):
+    lines = ["# TYPE apstra_request_duration_seconds histogram"]
+    for e in client['endpoints']:
+        labels = dict(pack=pack, method=e['method'], endpoint=e['endpoint'])
+        for bound, count in zip(client['buckets'], e['buckets']):
+            lines.append(f"apstra_request_duration_seconds_bucket{prometheus_labels(**labels, le=bound)} {count}")
+        lines.append(f"apstra_request_duration_seconds_bucket{prometheus_labels(**labels, le='+Inf')} {e['count']}")
+        lines.append(f"apstra_request_duration_seconds_sum{prometheus_labels(**labels)} {e['seconds']}")
+        lines.append(f"apstra_request_duration_seconds_count{prometheus_labels(**labels)} {e['count']}")
+    lines.append("# TYPE apstra_response_bytes_total counter")
+    for e in client['endpoints']:
+        labels = prometheus_labels(pack=pack, method=e['method'], endpoint=e['endpoint'])
+        lines.append(f"apstra_response_bytes_total{labels} {e['bytes_in']}")
+    lines.append("# TYPE apstra_request_bytes_total counter")
+    for e in client['endpoints']:
+        labels = prometheus_labels(pack=pack, method=e['method'], endpoint=e['endpoint'])
+        lines.append(f"apstra_request_bytes_total{labels} {e['bytes_out']}")
+    lines.append("# TYPE apstra_requests_total counter")
+    for st in client['statuses']:
+        labels = prometheus_labels(pack=pack, method=st['method'], endpoint=st['endpoint'], status=st['status'])
+        lines.append(f"apstra_requests_total{labels} {st['count']}")
+    lines.append("# TYPE apstra_relogins_total counter")
+    lines.append(f"apstra_relogins_total{prometheus_labels(pack=pack)} {client['relogins']}")
+    cache = {k: v for k, v in client['cache'].items() if isinstance(v, dict)}
+    if cache:
+        lines.append("# TYPE apstra_cache_hits_total counter")
+        lines.extend(f"apstra_cache_hits_total{prometheus_labels(pack=pack, resource=r)} {c['hits']}"
+                     for r, c in cache.items())
+        lines.append("# TYPE apstra_cache_misses_total counter")
+        lines.extend(f"apstra_cache_misses_total{prometheus_labels(pack=pack, resource=r)} {c['misses']}"
+                     for r, c in cache.items())
+    lines.append("# TYPE apstra_coalesced_requests_total counter")
+    for endpoint, count in client['coalescing']['endpoints'].items():
+        lines.append(f"apstra_coalesced_requests_total{prometheus_labels(pack=pack, endpoint=endpoint)} {count}")
+    if client['conditional']:
+        lines.append("# TYPE apstra_conditional_skipped_total counter")
+        for reason, field in (("not_modified", 'not_modified'), ("version", 'version_hits')):
+            lines.append(f"apstra_conditional_skipped_total{prometheus_labels(pack=pack, reason=reason)} "
+                         f"{client['conditional'][field]}")
+    return lines
+
+
+# Prometheus text exposition of PowerPackBase.metrics_snapshot(). A pack on a shared client has no client
+# section: the pack runtime exports the client once.
+def render_prometheus(snapshot):
+    pack = snapshot['pack']
+    lines = client_metric_lines(pack, snapshot['client']) if snapshot['client'] is not None else []
+    for name, kind, field in (("power_pack_overruns_total", "counter", 'overruns'),
+                              ("power_pack_skipped_ticks_total", "counter", 'skipped_ticks'),
+                              ("power_pack_max_lateness_seconds", "gauge", 'max_lateness'),
+                              ("power_pack_interval_seconds", "gauge", 'interval')):
+        lines.append(f"# TYPE {name} {kind}")
+        for loop, sch in snapshot['schedule'].items():
+            lines.append(f"{name}{prometheus_labels(pack=pack, loop=loop)} {sch[field]}")
+    for name, kind, field in (("power_pack_cycles_total", "counter", 'cycles'),
+                              ("power_pack_cycle_seconds_total", "counter", 'seconds'),
+                              ("power_pack_cycle_api_calls_total", "counter", 'calls'),
+                              ("power_pack_cycle_last_seconds", "gauge", 'last_seconds'),
+                              ("power_pack_cycle_last_api_calls", "gauge", 'last_calls'),
+                              ("power_pack_cycle_max_seconds", "gauge", 'max_seconds')):
+        lines.append(f"# TYPE {name} {kind}")
+        for loop, c in snapshot['cycles'].items():
+            lines.append(f"{name}{prometheus_labels(pack=pack, loop=loop)} {c[field]}")
+    if snapshot['startup']['first_cycle'] is not None:
+        lines.append("# TYPE power_pack_startup_seconds gauge")
+        lines.append(f"power_pack_startup_seconds{prometheus_labels(pack=pack)} {snapshot['startup']['first_cycle']}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        snapshot = self.server.owner.metrics_snapshot()
+        if self.path.startswith("/metrics"):
+            body, content_type = render_prometheus(snapshot).encode(), "text/plain; version=0.0.4"
+        elif self.path.startswith("/snapshot"):
+            body, content_type = json.dumps(snapshot, default=str).encode(), "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Serve /metrics (Prometheus text format) and /snapshot (JSON) of owner.metrics_snapshot() on a local port
+def serve_metrics(owner, port, host="127.0.0.1"):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.owner = owner
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"metrics served on http://{host}:{port}/metrics")
+    return server
+
+
+# Local control channel: one command per connection (pause, unpause, stop or status), answered with
+# the pack state as JSON. A pause given here holds until unpaused here, whatever the management
+# property set says.
+class ControlHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        command = self.rfile.readline().decode().strip().lower()
+        pack = self.server.pack
+        if command == "pause":
+            pack.pause(manual=True)
+        elif command in ("unpause", "resume"):
+            pack.unpause(manual=True)
+        elif command == "stop":
+            pack.request_stop()
+        elif command != "status":
+            self.wfile.write(json.dumps({'error': f"unknown command {command}"}).encode() + b"\n")
+            return
+        self.wfile.write(json.dumps(pack.control_status()).encode() + b"\n")
+
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def send_control(path, command):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        s.sendall(command.encode() + b"\n")
+        return s.makefile().readline().strip()
+
+
+# Apstra client configured from the APSTRA_* environment variables.
+# defer_login: log in on the first request rather than now.
+def make_apstra_client(defer_login=False):
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    aos_ip = os.environ.get('APSTRA_URL')
+    aos_port = os.environ.get('APSTRA_PORT')
+    aos_user = os.environ.get('APSTRA_USER')
+    aos_pw = os.environ.get('APSTRA_PASS')
+    pool_size = int(os.environ.get('APSTRA_POOL_SIZE', 10))
+    return ApstraClient( base_url=aos_ip, port=int(aos_port), username=aos_user, password=aos_pw, ssl_verify=True,
+                         pool_size=pool_size, defer_login=defer_login)
+
+
 class PowerPackBase:
-    def __init__(self, worker_callback, checker_callback, setup_file="setup.yaml"):
+    # aos_client: an already logged in client to share with other packs (see pack_runtime.py).
+    # Its cache and conditional fetching are then left as its owner configured them.
+    def __init__(self, worker_callback, checker_callback, setup_file="setup.yaml", event_callback=None,
+                 aos_client=None):
         self.setup = {}
         self.setup_file = setup_file
-        self.aos_client = self.get_apstra_client()
+        with startup_profile.phase(f"{type(self).__name__} setup"):
+            self.load_setup()
+        self.shared_client = aos_client is not None
+        # Not logged in yet: that happens with the first request the pack makes
+        self.aos_client = aos_client if self.shared_client else self.get_apstra_client()
         self.exit = threading.Event()
         self.go = threading.Event()
         self._worker = threading.Thread
         self._pause_checker = threading.Thread
         self._worker_callback = worker_callback
         self._checker_callback = checker_callback
+        self._event_callback = event_callback
+        self._events = queue.Queue()
+        self._receiver = None
+        self._metrics_server = None
+        self.cycle_stats = {'worker': CycleStats(), 'pause_check': CycleStats()}
+        self._loop = None
+        self._async_clients = []
+        self._control_server = None
+        # Notified on every pause, unpause and stop so waiting loops react at once
+        self._control = threading.Condition()
+        self.manual_pause = False
         self.exit.clear()
         self.go.set()
-        self.load_setup()
-
-    #    signal(SIGINT, self.break_handler)
+        # Worker and pause check can run at their own cadence, both default to wait_time_seconds
+        self.schedulers = {
+            'worker': DeadlineScheduler(self.setup.get('worker_interval_seconds', self.setup['wait_time_seconds']),
+                                        self.exit),
+            'pause_check': DeadlineScheduler(self.setup.get('pause_check_interval_seconds',
+                                                            self.setup['wait_time_seconds']), self.exit),
+        }
+        self.adaptive = self.make_adaptive_interval()
+        self.tracer = self.make_tracer()
+        self.profiler = None
+        self._profile_request = None
+        if self.setup.get('cache_ttl_seconds') and not self.shared_client:
+            self.aos_client.configure_cache(self.setup['cache_ttl_seconds'])
+        if self.setup.get('conditional_fetch') and not self.shared_client:
+            self.aos_client.configure_conditional(self.setup.get('version_probe_ttl_seconds', 2))
 
     # This will be the main loop that will be run.
     def worker_loop(self):
-        while not self.exit.is_set():
-            self.go.wait()
-            self._worker_callback()
-            time.sleep(self.setup['wait_time_seconds'])
-            print("working")
-            print(threading.get_ident())
+        scheduler = self.schedulers['worker']
+        while scheduler.wait_next():
+            if not self.go.is_set():
+                if not self.wait_for_go():
+                    break
+                # Time spent paused is not an overrun
+                scheduler.restart()
+            self.worker_cycle()
 
         print("Exiting Worker Loop.")
 
     # This will be used to check if we need to pause the main loop
     def  pause_check_loop(self):
-        while not self.exit.is_set():
+        scheduler = self.schedulers['pause_check']
+        while scheduler.wait_next():
             #print("checking pause")
             #print(threading.get_ident())
             #Check condition and decide if we are going to clear.
-            if self._checker_callback():
-                print("Pause Set, Pausing")
-                self.go.clear()
-            else:
-                self.go.set()
-            time.sleep(self.setup['wait_time_seconds'])
+            self.pause_check_cycle()
         print("Exiting Pause Check Loop.")
 
+    # A truthy return from the worker callback means it saw changes or is in the middle of acting on them
+    def worker_cycle(self):
+        active = self.run_cycle('worker', self._worker_callback)
+        if self.adaptive:
+            interval = self.adaptive.update(bool(active))
+            if interval != self.schedulers['worker'].interval:
+                print(f"worker interval now {interval} seconds")
+            self.schedulers['worker'].interval = interval
+        if startup_profile.cycle_done() and startup_profile.enabled:
+            print(startup_profile.report())
+        print("working")
+        print(threading.get_ident())
+
+    # adaptive_interval in setup.yaml: floor_seconds (default: the worker interval), ceiling_seconds
+    # (default: ten times the floor) and backoff (default: 2)
+    def make_adaptive_interval(self):
+        cfg = self.setup.get('adaptive_interval')
+        if not cfg:
+            return None
+        cfg = cfg if isinstance(cfg, dict) else {}
+        floor = cfg.get('floor_seconds', self.schedulers['worker'].interval)
+        adaptive = AdaptiveInterval(floor, cfg.get('ceiling_seconds', floor * 10), cfg.get('backoff', 2))
+        self.schedulers['worker'].interval = floor
+        return adaptive
+
+    # trace_file in setup.yaml: one JSON line per cycle with its requests, rotated at trace_max_bytes
+    def make_tracer(self):
+        if not self.setup.get('trace_file'):
+            return None
+        from tracing import CycleTracer
+        return CycleTracer(type(self).__name__, self.aos_client.metrics, self.setup['trace_file'],
+                           self.setup.get('trace_max_bytes', 10 * 1024 * 1024), self.setup.get('trace_backups', 3))
+
+    def pause_check_cycle(self):
+        if self.run_cycle('pause_check', self._checker_callback):
+            if self.go.is_set():
+                print("Pause Set, Pausing")
+            self.pause()
+        elif not self.manual_pause:
+            self.unpause()
+        if self.setup.get('profile_dir'):
+            self.check_profile_request()
+
+    # With profile_dir in setup.yaml, setting profile_cycles: N in the management property set profiles
+    # the next N worker cycles into profile_dir. A new profile starts whenever the value changes to a
+    # positive number; the value found at start up only sets the baseline.
+    def check_profile_request(self):
+        try:
+            ps = self.aos_client.get_property_set(self.setup['management_property_set'])
+            cycles = int((ps.get('values') or {}).get('profile_cycles') or 0)
+        except Exception as e:
+            logging.debug(f"profile_cycles not read: {e}")
+            return
+        previous, self._profile_request = self._profile_request, cycles
+        if previous is None or cycles == previous or cycles <= 0:
+            return
+        if self.profiler and not self.profiler.done.is_set():
+            return
+        from tracing import SamplingProfiler
+        path = os.path.join(self.setup['profile_dir'],
+                            f"{type(self).__name__}-{time.strftime('%Y%m%d-%H%M%S')}.folded")
+        self.profiler = SamplingProfiler(type(self).__name__, cycles, path,
+                                         self.setup.get('profile_sample_interval_seconds', 0.005))
+        self.profiler.start()
+
+    # Block while paused. False when the pack is stopping.
+    def wait_for_go(self):
+        with self._control:
+            self._control.wait_for(lambda: self.go.is_set() or self.exit.is_set())
+        return not self.exit.is_set()
+
+    # Run one cycle of a loop, recording its duration and the API calls it made, and tracing or
+    # profiling it when enabled
+    def run_cycle(self, loop, callback):
+        profiler = self.profiler
+        if profiler:
+            profiler.enter(loop)
+        span = self.tracer.start(loop) if self.tracer else None
+        calls = self.aos_client.metrics.thread_calls()
+        start = time.perf_counter()
+        ok = False
+        try:
+            result = callback()
+            ok = True
+            return result
+        finally:
+            self.cycle_stats[loop].record(time.perf_counter() - start,
+                                          self.aos_client.metrics.thread_calls() - calls)
+            if span:
+                self.tracer.finish(span, ok)
+            if profiler:
+                profiler.exit(loop)
+
+    # A shared client's metrics are not the pack's own; the pack runtime serves them once for all packs
+    def metrics_snapshot(self):
+        return {'pack': type(self).__name__,
+                'client': None if self.shared_client else self.aos_client.metrics_snapshot(),
+                'cycles': {loop: c.snapshot() for loop, c in self.cycle_stats.items()},
+                'schedule': {loop: sch.snapshot() for loop, sch in self.schedulers.items()},
+                'startup': startup_profile.snapshot()}
+
+    def start_metrics_server(self, port, host="127.0.0.1"):
+        self._metrics_server = serve_metrics(self, port, host)
+
+    # Streaming mode: anomaly changes pushed by Apstra are queued by the receiver and handed to the
+    # event callback here, so pausing holds them back the same way it holds back the worker.
+    def event_loop(self):
+        # Catch up on what changed while nothing was streamed to us (e.g. before a restart): one polling
+        # cycle closes what was cleared meanwhile and picks up what was raised
+        if self._worker_callback and self.wait_for_go():
+            self.run_cycle('worker', self._worker_callback)
+        # Ready to handle events: the streaming counterpart of the first worker cycle
+        if startup_profile.cycle_done() and startup_profile.enabled:
+            print(startup_profile.report())
+        while self.wait_for_go():
+            try:
+                item = self._events.get(timeout=1)
+            except queue.Empty:
+                continue
+            # None is queued by stop() to wake this loop
+            if item is None:
+                continue
+            kind, event = item
+            self.run_cycle('worker', lambda: self._event_callback(kind, event))
+        print("Exiting Event Loop.")
+
+    # Streamed anomalies are matched against the REST listings, so they carry the same ids as polled ones.
+    # The listings of the watched blueprints are read before the receiver starts.
+    def start_receiver(self):
+        from streaming_receiver import StreamingReceiver
+        cfg = self.setup['streaming']
+        self._receiver = StreamingReceiver(lambda kind, event: self._events.put((kind, event)),
+                                           host=cfg.get('listen_host', "0.0.0.0"), port=cfg.get('listen_port', 7777),
+                                           codec=cfg.get('codec', "protobuf"), record_path=cfg.get('record_path'),
+                                           lookup=self.aos_client.get_anomalies)
+        for bp_id in self.watched_bp_ids():
+            self._receiver.state.load(bp_id)
+        self._receiver.start()
+        if cfg.get('advertise_host'):
+            self.aos_client.create_streaming_config(cfg['advertise_host'], cfg.get('listen_port', 7777))
+
+    # Blueprints whose anomalies the pack handles, for packs that keep such a list
+    def watched_bp_ids(self):
+        return []
+
+    def streaming_enabled(self):
+        return bool(self.setup.get('streaming')) and self._event_callback is not None
+
+    # Fast path for pause / unpause / stop next to the property set poll: a unix socket when
+    # control_socket is set, and SIGUSR1 (pause), SIGUSR2 (unpause), SIGTERM / SIGINT (stop) unless
+    # `signals` is off, e.g. when a pack runtime handles them for all its packs
+    def start_control(self, signals=True):
+        path = self.setup.get('control_socket')
+        if path and self._control_server is None:
+            if os.path.exists(path):
+                os.unlink(path)
+            self._control_server = ControlServer(path, ControlHandler)
+            self._control_server.pack = self
+            threading.Thread(target=self._control_server.serve_forever, daemon=True).start()
+            print(f"control socket at {path}")
+        # Signal handlers can only be installed from the main thread
+        if signals and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.pause(manual=True))
+            signal.signal(signal.SIGUSR2, lambda signum, frame: self.unpause(manual=True))
+            signal.signal(signal.SIGTERM, self.break_handler)
+            signal.signal(signal.SIGINT, self.break_handler)
+
+    def control_status(self):
+        return {'pack': type(self).__name__, 'paused': self.is_paused(), 'manual_pause': self.manual_pause,
+                'stopping': self.exit.is_set(),
+                'profiling': self.profiler.remaining if self.profiler and not self.profiler.done.is_set() else 0}
+
     def start_threads(self, blocking=True, pause_check=True):
         print ("starting threads")
-        self._worker = threading.Thread(target=self.worker_loop)
+        self.start_control()
+        if self.setup.get('metrics_port') and self._metrics_server is None:
+            self.start_metrics_server(self.setup['metrics_port'], self.setup.get('metrics_host', "127.0.0.1"))
+        if self.streaming_enabled():
+            print("streaming enabled, start receiver instead of polling")
+            self.start_receiver()
+            self._worker = threading.Thread(target=self.event_loop)
+        else:
+            self._worker = threading.Thread(target=self.worker_loop)
         self._worker.start()
 
         if pause_check:
@@ -61,8 +578,11 @@ class PowerPackBase:
             self._pause_checker = threading.Thread(target=self.pause_check_loop)
             self._pause_checker.start()
 
+        # Stopped from here rather than from the signal handler, so the interpreter does not exit
+        # while stop() is still writing out the pack's state
         if blocking:
             self._worker.join()
+            self.stop()
 
     # Load the yaml file with the config
     def load_setup(self):
@@ -71,26 +591,103 @@ class PowerPackBase:
 
     # Set up the apstra client
     def get_apstra_client(self):
-        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-        aos_ip = os.environ.get('APSTRA_URL')
-        aos_port = os.environ.get('APSTRA_PORT')
-        aos_user = os.environ.get('APSTRA_USER')
-        aos_pw = os.environ.get('APSTRA_PASS')
-        return ApstraClient( base_url=aos_ip, port=int(aos_port), username=aos_user, password=aos_pw, ssl_verify=True)
-
-    def pause(self):
-        self.go.clear()
+        return make_apstra_client(defer_login=True)
+
+    # Set up the asyncio client, reusing the token of the blocking client. Its session is closed by stop().
+    # aiohttp is only needed by packs that call this.
+    def get_async_apstra_client(self, max_concurrency=8):
+        from async_apstra_client import AsyncApstraClient
+        client = AsyncApstraClient(base_url=self.aos_client.base_url, port=self.aos_client.port,
+                                 username=self.aos_client.username, password=self.aos_client.password,
+                                 ssl_verify=self.aos_client.ssl_verify, max_concurrency=max_concurrency,
+                                 auth_token=self.aos_client.ensure_login(), metrics=self.aos_client.metrics,
+                                 conditional=self.aos_client.conditional is not None)
+        self._async_clients.append(client)
+        return client
+
+    # Run a coroutine to completion on the pack's event loop. The loop is kept between calls so
+    # the async client's connection pool survives from one cycle to the next.
+    def run_async(self, coro):
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        return self._loop.run_until_complete(coro)
+
+    # manual: given over the control channel, and held until unpaused the same way
+    def pause(self, manual=False):
+        with self._control:
+            if manual:
+                self.manual_pause = True
+            self.go.clear()
+            self._control.notify_all()
         #print(self.go.is_set())
 
-    def unpause(self):
+    def unpause(self, manual=False):
         #print( "In unpause")
-        self.go.set()
+        with self._control:
+            if manual:
+                self.manual_pause = False
+            self.go.set()
+            self._control.notify_all()
 
-    def stop(self):
-        self.exit.set()
+    # Wakes every wait at once so the loops return once the cycle in progress finishes; whoever
+    # started the pack then stops it
+    def request_stop(self):
+        with self._control:
+            self.exit.set()
+            self._control.notify_all()
+        self._events.put(None)
 
+    # The threads are joined for up to `timeout` seconds
+    def stop(self, timeout=10):
+        self.request_stop()
+        if self._receiver:
+            self._receiver.stop()
+            self._receiver = None
+        if self._metrics_server:
+            self._metrics_server.shutdown()
+            self._metrics_server.server_close()
+            self._metrics_server = None
+        if self._control_server:
+            self._control_server.shutdown()
+            self._control_server.server_close()
+            # Already gone when another process took the path over, or it was cleaned up by hand
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self.setup['control_socket'])
+            self._control_server = None
+        for t in (self._worker, self._pause_checker):
+            if isinstance(t, threading.Thread) and t.is_alive() and t is not threading.current_thread():
+                t.join(timeout)
+        if self.profiler:
+            self.profiler.stop()
+        if self.tracer:
+            self.tracer.close()
+        self.close_loop()
+
+    # Close the sessions of the async clients on the loop that opened them, then the loop itself.
+    # Left alone while a cycle still runs on it, e.g. when the worker did not finish within the timeout.
+    def close_loop(self):
+        if self._loop is None or self._loop.is_running():
+            return
+        for client in self._async_clients:
+            try:
+                self._loop.run_until_complete(client.close())
+            except Exception as e:
+                logging.warning(f"async client not closed: {e}")
+        self._loop.close()
+        self._loop = None
+
+    # SIGTERM / SIGINT: the worker returns and start_threads stops the pack on the main thread.
+    # Handlers run on the main thread, which may be holding the control lock.
     def break_handler(self, signal_received, frame):
-        self.stop()
+        threading.Thread(target=self.request_stop, daemon=True).start()
 
     def is_paused(self):
-        return not self.go.is_set()
\ No newline at end of file
+        return not self.go.is_set()
+
+
+if __name__ == '__main__':
+    # python3 power_pack.py <control socket> pause|unpause|stop|status
+    if len(sys.argv) == 3:
+        print(send_control(sys.argv[1], sys.argv[2]))
+    else:
+        print("Usage : python3 power_pack.py <control socket> pause|unpause|stop|status")
@@ -0,0 +1,231 @@
+import bisect
+import contextlib
+import fcntl
+import hashlib
+import logging
+import multiprocessing
+import os
+import signal
+import sqlite3
+import sys
+import threading
+import time
+
+import yaml
+
+logger = logging.getLogger(__name__)
+
+
+def ring_position(value):
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+
+# Consistent hash ring: a key belongs to the first member point at or after the key's position.
+# When a member joins or leaves only the keys next to its points move.
+class HashRing:
+    def __init__(self, members, vnodes=64):
+        self.members = sorted(members)
+        self._points = sorted((ring_position(f"{m}#{i}"), m) for m in self.members for i in range(vnodes))
+        self._positions = [p for p, _ in self._points]
+
+    def owner(self, key):
+        if not self._points:
+            return None
+        i = bisect.bisect(self._positions, ring_position(key)) % len(self._points)
+        return self._points[i][1]
+
+
+# Worker heartbeats and key leases in a SQLite database on the local host. A lease is only granted
+# when the key is free, expired or already held by the asking worker, so a key has one owner at a time.
+class LeaseStore:
+    def __init__(self, path, ttl=30):
+        self.path = path
+        self.ttl = ttl
+        with self.connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE IF NOT EXISTS workers (worker TEXT PRIMARY KEY, heartbeat REAL)")
+            db.execute("CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, owner TEXT, expires REAL)")
+
+    # A connection per call: the store is used from several threads and processes
+    def connect(self):
+        return contextlib.closing(sqlite3.connect(self.path, timeout=10, isolation_level=None))
+
+    def heartbeat(self, worker):
+        now = time.time()
+        with self.connect() as db:
+            db.execute("INSERT INTO workers VALUES (?, ?) "
+                       "ON CONFLICT(worker) DO UPDATE SET heartbeat=excluded.heartbeat", (worker, now))
+            db.execute("UPDATE leases SET expires=? WHERE owner=?", (now + self.ttl, worker))
+
+    def live_workers(self):
+        with self.connect() as db:
+            rows = db.execute("SELECT worker FROM workers WHERE heartbeat > ?", (time.time() - self.ttl,))
+            return [w for w, in rows]
+
+    def acquire(self, key, worker):
+        now = time.time()
+        with self.connect() as db:
+            db.execute("INSERT INTO leases VALUES (?, ?, ?) ON CONFLICT(key) DO UPDATE "
+                       "SET owner=excluded.owner, expires=excluded.expires "
+                       "WHERE leases.owner=excluded.owner OR leases.expires < ?", (key, worker, now + self.ttl, now))
+            return db.execute("SELECT owner FROM leases WHERE key=?", (key,)).fetchone()[0] == worker
+
+    def release(self, key, worker):
+        with self.connect() as db:
+            db.execute("DELETE FROM leases WHERE key=? AND owner=?", (key, worker))
+
+    def leave(self, worker):
+        with self.connect() as db:
+            db.execute("DELETE FROM leases WHERE owner=?", (worker,))
+            db.execute("DELETE FROM workers WHERE worker=?", (worker,))
+
+    # Host-wide mutex (an flock'ed file next to the database), e.g. around read-merge-write updates
+    # of a property set shared by all workers
+    @contextlib.contextmanager
+    def lock(self, name):
+        with open(f"{self.path}.{name}.lock", "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+# One worker's view of the shards: which of the keys it owns, kept alive by a heartbeat thread
+class ShardMember:
+    def __init__(self, store, worker):
+        self.store = store
+        self.worker = worker
+        self.owned = set()
+        self._stop = threading.Event()
+
+    def start_heartbeat(self):
+        self.store.heartbeat(self.worker)
+        threading.Thread(target=self.heartbeat_loop, daemon=True).start()
+
+    def heartbeat_loop(self):
+        while not self._stop.wait(self.store.ttl / 3):
+            try:
+                self.store.heartbeat(self.worker)
+            except sqlite3.Error as e:
+                logger.error(f"Heartbeat of {self.worker} failed: {e}")
+
+    # Keys this worker should own given the live workers, leased where possible.
+    # on_release(keys) is called with the keys about to be given up while they are still owned, e.g. to
+    # write out their state, and returns those that can go now; the others are kept until a later call.
+    # It is also called for keys whose lease was taken over, once they are no longer in `owned`, so
+    # nothing is written for them.
+    # Returns (acquired, released) since the last call.
+    def rebalance(self, keys, on_release=None):
+        previous = set(self.owned)
+        # Leases taken over (e.g. after missed heartbeats) go first, so writing out the keys that are
+        # leaving does not overwrite their new owner's state
+        self.drop_lost({k for k in self.owned if not self.store.acquire(k, self.worker)}, on_release)
+        ring = HashRing(set(self.store.live_workers()) | {self.worker})
+        wanted = {k for k in keys if ring.owner(k) == self.worker}
+        leaving = self.owned - wanted
+        if leaving and on_release:
+            leaving = set(on_release(leaving))
+        for k in leaving:
+            self.store.release(k, self.worker)
+        owned = {k for k in wanted | (self.owned - leaving) if self.store.acquire(k, self.worker)}
+        self.drop_lost(self.owned - leaving - owned, on_release)
+        acquired, released = owned - previous, previous - owned
+        self.owned = owned
+        if acquired or released:
+            print(f"{self.worker}: owns {len(owned)} keys, {len(acquired)} acquired, {len(released)} released")
+        return acquired, released
+
+    def drop_lost(self, lost, on_release):
+        if not lost:
+            return
+        logger.warning(f"{self.worker}: {len(lost)} keys taken over by another worker")
+        self.owned -= lost
+        if on_release:
+            on_release(lost)
+
+    def lock(self, name):
+        return self.store.lock(name)
+
+    def leave(self):
+        self._stop.set()
+        self.store.leave(self.worker)
+        self.owned = set()
+
+
+def run_shard(pack_class, setup_file, lease_path, ttl, worker):
+    member = ShardMember(LeaseStore(lease_path, ttl), worker)
+    member.start_heartbeat()
+    try:
+        pack = pack_class(setup_file=setup_file, shard=member)
+        pack.start_threads(blocking=True)
+    finally:
+        member.leave()
+
+
+# Runs one pack per process, the processes sharing the pack's keys (e.g. blueprints) through a hash
+# ring over the live workers. A process that dies stops heartbeating: the others take over its keys
+# once its leases expire, and it is started again.
+class ShardedRunner:
+    def __init__(self, pack_class, setup_file="setup.yaml", processes=None, lease_path="shards.db", ttl=30):
+        self.pack_class = pack_class
+        self.setup_file = setup_file
+        self.processes = processes or os.cpu_count()
+        self.lease_path = lease_path
+        self.ttl = ttl
+        self.exit = threading.Event()
+        self.workers = {}
+
+    # shards section of the setup file (processes, lease_path, lease_ttl_seconds), or None when unset
+    @classmethod
+    def from_setup(cls, pack_class, setup_file="setup.yaml"):
+        with open(setup_file, "r") as s:
+            cfg = (yaml.safe_load(s) or {}).get('shards')
+        if not cfg:
+            return None
+        return cls(pack_class, setup_file, cfg.get('processes'), cfg.get('lease_path', "shards.db"),
+                   cfg.get('lease_ttl_seconds', 30))
+
+    def start_worker(self, name):
+        p = multiprocessing.Process(target=run_shard, name=name, daemon=False,
+                                    args=(self.pack_class, self.setup_file, self.lease_path, self.ttl, name))
+        p.start()
+        self.workers[name] = p
+
+    def run(self):
+        LeaseStore(self.lease_path, self.ttl)
+        for i in range(self.processes):
+            self.start_worker(f"shard-{i}")
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda signum, frame: self.exit.set())
+        try:
+            while not self.exit.wait(1):
+                for name, p in list(self.workers.items()):
+                    if not p.is_alive():
+                        print(f"{name} exited with {p.exitcode}, restarting")
+                        self.start_worker(name)
+        except KeyboardInterrupt:
+            pass
+        self.stop()
+
+    def stop(self, timeout=30):
+        self.exit.set()
+        for p in self.workers.values():
+            if p.is_alive():
+                p.terminate()
+        for p in self.workers.values():
+            p.join(timeout)
+
+
+if __name__ == '__main__':
+    # python3 sharding.py <module> <class> [setup.yaml]
+    if len(sys.argv) < 3:
+        print("Usage : python3 sharding.py <module> <class> [setup.yaml]")
+        sys.exit(1)
+    import importlib
+    cls = getattr(importlib.import_module(sys.argv[1]), sys.argv[2])
+    runner = ShardedRunner.from_setup(cls, sys.argv[3] if len(sys.argv) > 3 else "setup.yaml")
+    if runner is None:
+        print("No shards section in the setup file")
+        sys.exit(1)
+    runner.run()
@@ -0,0 +1,129 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+# Pack state (e.g. open tickets by anomaly id) kept as a dict that remembers which keys changed.
+# flush() hands the whole state to `write` (usually a property set update) only when something
+# changed, and at most every flush_interval seconds. Every change is also written through to a local
+# SQLite checkpoint, so a restart can resume from it instead of reloading the property set.
+# Entries are replaced, not modified in place: only setting or removing a key marks it dirty.
+class StateStore(dict):
+    def __init__(self, write, flush_interval=0, checkpoint_path=None):
+        super().__init__()
+        self.write = write
+        self.flush_interval = flush_interval
+        self.checkpoint_path = checkpoint_path
+        self.dirty = set()
+        self.flushes = 0
+        self.skipped = 0
+        self._last_flush = 0.0
+        self._lock = threading.RLock()
+        self._db = None
+        if checkpoint_path:
+            self._db = sqlite3.connect(checkpoint_path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS dirty (key TEXT PRIMARY KEY)")
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            super().__setitem__(key, value)
+            self.mark(key, value)
+
+    def __delitem__(self, key):
+        with self._lock:
+            super().__delitem__(key)
+            self.mark(key)
+
+    def pop(self, key, *default):
+        with self._lock:
+            if key not in self:
+                return super().pop(key, *default)
+            value = super().pop(key)
+            self.mark(key)
+            return value
+
+    def setdefault(self, key, default=None):
+        with self._lock:
+            if key not in self:
+                self[key] = default
+            return self[key]
+
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).items():
+            self[k] = v
+
+    def clear(self):
+        for k in list(self):
+            del self[k]
+
+    # Record a change in memory and in the checkpoint. value is None for a removal.
+    def mark(self, key, value=None):
+        self.dirty.add(key)
+        if self._db:
+            if key in self:
+                self._db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?)", (key, json.dumps(value)))
+            else:
+                self._db.execute("DELETE FROM entries WHERE key=?", (key,))
+            self._db.execute("INSERT OR IGNORE INTO dirty VALUES (?)", (key,))
+
+    # Entries as persisted elsewhere (e.g. read from the property set): not dirty
+    def load(self, entries):
+        with self._lock:
+            for k, v in entries.items():
+                super().__setitem__(k, v)
+                if self._db:
+                    self._db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?)", (k, json.dumps(v)))
+
+    # Drop an entry from this process without persisting the removal (it now belongs elsewhere)
+    def forget(self, key):
+        with self._lock:
+            super().pop(key, None)
+            self.dirty.discard(key)
+            if self._db:
+                self._db.execute("DELETE FROM entries WHERE key=?", (key,))
+                self._db.execute("DELETE FROM dirty WHERE key=?", (key,))
+
+    # Load the checkpoint, changes that were not flushed before the restart included.
+    # False when there is no checkpoint to resume from.
+    def restore(self):
+        if not (self._db and os.path.getsize(self.checkpoint_path)):
+            return False
+        with self._lock:
+            rows = self._db.execute("SELECT key, value FROM entries").fetchall()
+            dirty = [k for k, in self._db.execute("SELECT key FROM dirty")]
+            if not rows and not dirty:
+                return False
+            for k, v in rows:
+                super().__setitem__(k, json.loads(v))
+            self.dirty.update(dirty)
+        return True
+
+    # Persist the state when it changed and the flush interval has passed (or force).
+    # Returns whether it was written.
+    def flush(self, force=False):
+        with self._lock:
+            if not self.dirty:
+                self.skipped += 1
+                return False
+            if not force and time.monotonic() - self._last_flush < self.flush_interval:
+                return False
+            dirty = set(self.dirty)
+            self.write(dict(self))
+            self.dirty -= dirty
+            if self._db:
+                self._db.executemany("DELETE FROM dirty WHERE key=?", [(k,) for k in dirty])
+            self._last_flush = time.monotonic()
+            self.flushes += 1
+            return True
+
+    def close(self):
+        if self._db:
+            self._db.close()
+            self._db = None
+
+    def stats(self):
+        return {'entries': len(self), 'dirty': len(self.dirty), 'flushes': self.flushes, 'skipped': self.skipped}
@@ -0,0 +1,267 @@
+import hashlib
+import importlib
+import json
+import logging
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Apstra streams protobuf messages over TCP, each preceded by its length as a 2 byte big-endian integer
+FRAME_HEADER = struct.Struct("!H")
+
+# Alert fields that carry measurements rather than identity
+ALERT_VALUE_FIELDS = ('expected', 'actual', 'expected_value', 'actual_value', 'value')
+
+
+def read_frames(stream):
+    while True:
+        header = stream.read(FRAME_HEADER.size)
+        if len(header) < FRAME_HEADER.size:
+            return
+        size, = FRAME_HEADER.unpack(header)
+        body = stream.read(size)
+        if len(body) < size:
+            return
+        yield body
+
+
+def write_frame(stream, body):
+    stream.write(FRAME_HEADER.pack(len(body)) + body)
+
+
+# Decodes Apstra AosMessage frames using the python module generated from Apstra's streaming schema
+# (protoc --python_out=. streaming-telemetry-schema.proto). Only alerts are turned into events.
+class ProtobufDecoder:
+    def __init__(self, schema_module="streaming_telemetry_schema_pb2"):
+        self.schema_module = schema_module
+        self._message = None
+        self._to_dict = None
+
+    def load(self):
+        if self._message is None:
+            from google.protobuf.json_format import MessageToDict
+            self._message = importlib.import_module(self.schema_module).AosMessage
+            self._to_dict = MessageToDict
+
+    def decode(self, frame):
+        self.load()
+        msg = self._message()
+        msg.ParseFromString(frame)
+        if not msg.HasField('alert'):
+            return None
+        return alert_to_event(self._to_dict(msg.alert, preserving_proto_field_name=True))
+
+
+# Frames already holding an event as JSON, as written by the replay sender
+class JsonDecoder:
+    def decode(self, frame):
+        return json.loads(frame)
+
+
+DECODERS = {
+    'protobuf': ProtobufDecoder,
+    'json': JsonDecoder,
+}
+
+
+# What identifies an anomaly whether it was listed by the REST API or streamed: its type and its
+# identity fields without the measured values
+def anomaly_key(a):
+    identity = {k: v for k, v in (a.get('identity') or {}).items()
+                if k not in ALERT_VALUE_FIELDS and k != 'anomaly_type'}
+    return json.dumps({'type': a.get('anomaly_type'), 'identity': identity}, sort_keys=True, default=str)
+
+
+# Turn an AosAlert (as a dict) into {'raised', 'blueprint_id', 'anomaly'}, where the anomaly has the
+# same shape as an item of /api/blueprints/{id}/anomalies. The anomaly id is derived from the alert
+# type and its identity fields, so a raise and its clear map to the same id. AnomalyState replaces it
+# with the REST id when the blueprint's listing has the anomaly.
+def alert_to_event(alert):
+    alert_type = next((k for k in alert if k.endswith('_alert')), 'unknown_alert')
+    detail = alert.get(alert_type, {})
+    identity = {k: v for k, v in detail.items() if k not in ALERT_VALUE_FIELDS}
+    identity['system_id'] = alert.get('origin_name')
+    anomaly = {
+        'anomaly_type': alert_type[:-len('_alert')],
+        'severity': alert.get('severity'),
+        'identity': identity,
+        'expected': {'value': detail.get('expected', detail.get('expected_value'))},
+        'actual': {'value': detail.get('actual', detail.get('actual_value'))},
+    }
+    anomaly = {'id': hashlib.blake2b(anomaly_key(anomaly).encode(), digest_size=16).hexdigest()} | anomaly
+    return {'raised': alert.get('raised', True), 'blueprint_id': alert.get('blueprint_id'), 'anomaly': anomaly}
+
+
+# Currently raised anomalies, built from the event stream.
+# lookup(bp_id) returns a blueprint's anomalies from the REST API. Streamed anomalies are given the ids
+# found there, so they match the ids seen when polling (and those of tickets opened while polling).
+class AnomalyState:
+    def __init__(self, lookup=None, lookup_interval=5):
+        self.anomalies = {}
+        self.lookup = lookup
+        self.lookup_interval = lookup_interval
+        # (blueprint id, anomaly_key) -> anomaly id, kept after a clear for when the anomaly is raised again
+        self.ids = {}
+        self._looked_up = {}
+        self._lock = threading.Lock()
+
+    # Ids of anomalies known from a REST listing
+    def seed(self, bp_id, anomalies):
+        with self._lock:
+            for a in anomalies:
+                self.ids[(bp_id, anomaly_key(a))] = a['id']
+
+    def load(self, bp_id):
+        try:
+            anomalies = self.lookup(bp_id) or []
+        except Exception as e:
+            logger.warning(f"Anomaly lookup for blueprint {bp_id} failed: {e}")
+            anomalies = []
+        with self._lock:
+            self._looked_up[bp_id] = time.monotonic()
+        self.seed(bp_id, anomalies)
+
+    # Id to report a streamed anomaly under. The blueprint's listing is looked up the first time it
+    # is seen, and again (at most every lookup_interval seconds) for a raise it did not have.
+    # Anomalies the listing does not have keep the id derived from the alert.
+    def resolve(self, bp_id, a, raised):
+        key = (bp_id, anomaly_key(a))
+        with self._lock:
+            known = self.ids.get(key)
+            last = self._looked_up.get(bp_id)
+        if known is None and self.lookup and (
+                last is None or raised and time.monotonic() - last >= self.lookup_interval):
+            self.load(bp_id)
+            with self._lock:
+                known = self.ids.get(key)
+        if known is None and raised:
+            with self._lock:
+                known = self.ids.setdefault(key, a['id'])
+        return known or a['id']
+
+    # Returns 'added', 'changed', 'cleared' or None when the event changes nothing. Clears are always
+    # passed on, also for anomalies raised before this process started.
+    def apply(self, event):
+        bp_id = event.get('blueprint_id')
+        raised = event.get('raised', True)
+        a = event['anomaly']
+        a = event['anomaly'] = a | {'id': self.resolve(bp_id, a, raised)}
+        with self._lock:
+            old = self.anomalies.get(a['id'])
+            if not raised:
+                self.anomalies.pop(a['id'], None)
+                return 'cleared'
+            self.anomalies[a['id']] = (bp_id, a)
+            if old is None:
+                return 'added'
+            return 'changed' if old[1] != a else None
+
+
+class FrameHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        logger.info(f"Streaming sender connected from {self.client_address}")
+        for frame in read_frames(self.rfile):
+            self.server.receiver.on_frame(frame)
+        logger.info(f"Streaming sender {self.client_address} disconnected")
+
+
+class ReceiverServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+# Listens for Apstra's streaming connection, decodes frames, keeps the anomaly state and calls
+# on_event(kind, event) for every change. Raw frames can be recorded for replay.
+# lookup: see AnomalyState
+class StreamingReceiver:
+    def __init__(self, on_event, host="0.0.0.0", port=7777, codec="protobuf", record_path=None, lookup=None,
+                 **decoder_args):
+        self.on_event = on_event
+        self.decoder = DECODERS[codec](**decoder_args)
+        self.state = AnomalyState(lookup)
+        self.record_path = record_path
+        self._record = None
+        self._record_lock = threading.Lock()
+        self._server = ReceiverServer((host, port), FrameHandler)
+        self._server.receiver = self
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def start(self):
+        if self.record_path:
+            self._record = open(self.record_path, "ab")
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        logger.info(f"Streaming receiver listening on {self.address}")
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._record:
+            self._record.close()
+
+    def on_frame(self, frame):
+        if self._record:
+            with self._record_lock:
+                write_frame(self._record, frame)
+        try:
+            event = self.decoder.decode(frame)
+        except Exception as e:
+            logger.exception(f"Failed to decode streaming frame: {e}")
+            return
+        if event is None:
+            return
+        kind = self.state.apply(event)
+        if kind:
+            self.on_event(kind, event)
+
+
+# Local stand-in for Apstra: replays a recorded capture (or a list of events) to a receiver
+class ReplaySender:
+    def __init__(self, host="127.0.0.1", port=7777, interval=0.0):
+        self.host = host
+        self.port = port
+        self.interval = interval
+
+    def send_frames(self, frames):
+        with socket.create_connection((self.host, self.port)) as s:
+            stream = s.makefile("wb")
+            for frame in frames:
+                write_frame(stream, frame)
+                stream.flush()
+                if self.interval:
+                    time.sleep(self.interval)
+
+    # Events in the JsonDecoder format
+    def send_events(self, events):
+        self.send_frames(json.dumps(e).encode() for e in events)
+
+    def replay(self, capture_path):
+        with open(capture_path, "rb") as f:
+            self.send_frames(read_frames(f))
+
+
+if __name__ == '__main__':
+    # python streaming_receiver.py replay <capture file> [host] [port]
+    # python streaming_receiver.py listen [port] [codec]
+    if len(sys.argv) > 2 and sys.argv[1] == "replay":
+        host = sys.argv[3] if len(sys.argv) > 3 else "127.0.0.1"
+        port = int(sys.argv[4]) if len(sys.argv) > 4 else 7777
+        ReplaySender(host, port).replay(sys.argv[2])
+    elif len(sys.argv) > 1 and sys.argv[1] == "listen":
+        port = int(sys.argv[2]) if len(sys.argv) > 2 else 7777
+        codec = sys.argv[3] if len(sys.argv) > 3 else "protobuf"
+        r = StreamingReceiver(lambda kind, event: print(kind, json.dumps(event)), port=port, codec=codec)
+        r.start()
+        threading.Event().wait()
+    else:
+        print("Usage : python3 streaming_receiver.py replay <capture file> [host] [port]\n"
+              "        python3 streaming_receiver.py listen [port] [codec]")
@@ -0,0 +1,138 @@
+import json
+import logging
+import logging.handlers
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+# One rotating handler per trace file, so packs sharing a process (pack_runtime.py) and a file do
+# not rotate it under each other
+_handlers = {}
+_handlers_lock = threading.Lock()
+
+
+def trace_handler(path, max_bytes, backups):
+    with _handlers_lock:
+        handler = _handlers.get(path)
+        if handler is None:
+            handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            _handlers[path] = handler
+        return handler
+
+
+# A cycle being traced: the requests made by its thread are added as child spans
+class Span:
+    def __init__(self, loop):
+        self.loop = loop
+        self.wall = time.time()
+        self.start = time.perf_counter()
+        self.calls = []
+
+
+# Writes one JSON line per cycle of a pack:
+#   {"ts": 1700000000.123, "pack": "SNOWPowerPack", "loop": "worker", "ms": 812.4, "ok": true,
+#    "calls": [["GET", "/api/blueprints/x/anomalies", 200, 3.1, 240.7], ...]}
+# ms is the callback duration. Each call is [method, endpoint, status, start offset ms, duration ms],
+# recorded through the client metrics on the thread that runs the cycle.
+class CycleTracer:
+    def __init__(self, pack, metrics, path, max_bytes=10 * 1024 * 1024, backups=3):
+        self.pack = pack
+        self.metrics = metrics
+        self.handler = trace_handler(path, max_bytes, backups)
+        self.spans = 0
+        self._local = threading.local()
+        metrics.add_listener(self.on_request)
+
+    def start(self, loop):
+        span = self._local.span = Span(loop)
+        return span
+
+    def on_request(self, method, endpoint, status, seconds):
+        span = getattr(self._local, 'span', None)
+        if span is None:
+            return
+        end = time.perf_counter()
+        span.calls.append([method, endpoint, status, round((end - seconds - span.start) * 1000, 1),
+                           round(seconds * 1000, 1)])
+
+    def finish(self, span, ok=True):
+        self._local.span = None
+        line = json.dumps({'ts': round(span.wall, 3), 'pack': self.pack, 'loop': span.loop,
+                           'ms': round((time.perf_counter() - span.start) * 1000, 1), 'ok': ok,
+                           'calls': span.calls}, separators=(",", ":"))
+        self.handler.handle(logging.makeLogRecord({'msg': line}))
+        self.spans += 1
+
+    def close(self):
+        self.metrics.remove_listener(self.on_request)
+        self.handler.flush()
+
+
+# "file.py:function" frames from the outermost call to `frame`
+def fold_stack(frame):
+    names = []
+    while frame is not None:
+        names.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+# Samples the stacks of the threads running a pack's cycles every `interval` seconds until `cycles`
+# worker cycles have finished, then writes them as folded stacks ("loop;frame;frame count" per line),
+# which flamegraph.pl, speedscope and inferno read as they are. Threads outside a cycle are not sampled.
+class SamplingProfiler:
+    def __init__(self, pack, cycles, path, interval=0.005):
+        self.pack = pack
+        self.remaining = cycles
+        self.path = path
+        self.interval = interval
+        self.samples = Counter()
+        self.active = {}
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self.sample_loop, name=f"profiler-{self.pack}", daemon=True).start()
+        print(f"{self.pack}: profiling the next {self.remaining} worker cycles")
+
+    def sample_loop(self):
+        while not self.done.wait(self.interval):
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, loop in self.active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        self.samples[f"{loop};{fold_stack(frame)}"] += 1
+
+    def enter(self, loop):
+        with self._lock:
+            self.active[threading.get_ident()] = loop
+
+    # The last worker cycle writes the profile
+    def exit(self, loop):
+        with self._lock:
+            self.active.pop(threading.get_ident(), None)
+            if loop != 'worker' or self.done.is_set():
+                return
+            self.remaining -= 1
+            if self.remaining > 0:
+                return
+            self.done.set()
+        self.write()
+
+    def stop(self):
+        self.done.set()
+
+    def write(self):
+        try:
+            with open(self.path, "w") as f:
+                for stack, count in sorted(self.samples.items()):
+                    f.write(f"{stack} {count}\n")
+            print(f"{self.pack}: profile of {sum(self.samples.values())} samples written to {self.path}")
+        except OSError as e:
+            logger.error(f"Could not write profile {self.path}: {e}")